@@ -11,10 +11,16 @@ bl_info = {
 
 from . multifile import register, unregister, add_module, import_modules
 
+add_module("memory")
+add_module("tracing")
+add_module("backends")
 add_module("interface")
-add_module("draw_3d")
 add_module("utils")
-add_module("springs")
 add_module("manager")
+add_module("draw_3d", lazy=True)
+add_module("history", lazy=True)
+add_module("springs", lazy=True)
 # add_module("core_test")
+# add_module("backend_test")
+# add_module("benchmarks")
 import_modules()
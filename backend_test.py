@@ -0,0 +1,127 @@
+import bpy
+import bmesh
+import time
+import numpy as np
+from .multifile import register_class
+from .interface import get_settings
+from .backends import backend_names, get_backend_class, missing_members, REFERENCE_BACKEND
+
+# Max deviation from the reference engine, relative to the mesh size.
+tolerance = 1e-4
+repeats = 20
+
+
+def _stages(engine, springs):
+    # stiffness == springs makes every backend use its whole spring table instead of a random sample,
+    # so results are comparable without sharing a random generator.
+    return (("springs_force_apply", lambda: engine.springs_force_apply(factor=0.9, stiffness=springs,
+                                                                       springs=springs)),
+            ("implicit_solve", lambda: engine.implicit_solve(factor=0.9, springs=springs)),
+            ("smooth", lambda: engine.smooth(factor=0.5)),
+            ("target_attract", lambda: engine.target_attract(factor=0.5)),
+            ("movement_step", lambda: engine.movement_step(drag=0.5)),
+            ("x_mirror_apply", lambda: engine.x_mirror_apply()),
+            ("pins_apply", lambda: engine.pins_apply()),
+            ("repulsion_apply", lambda: engine.repulsion_apply(factor=0.5, distance=0.5)))
+
+
+def _copy_state(src, dst):
+    dst.co = src.co.copy()
+    dst.last_co = src.last_co.copy()
+
+
+def _timed(stage, engine, start):
+    _copy_state(start, engine)
+    t = time.perf_counter()
+    for i in range(repeats):
+        stage()
+    return time.perf_counter() - t
+
+
+def run_conformance(source_bm, target_bm, max_springs=100, x_mirror=True, springs=30):
+    reference = get_backend_class(REFERENCE_BACKEND)(source_bm, target_bm, max_springs, x_mirror, 6)
+    springs = min(springs, reference.max_springs)
+    size = np.ptp(reference.co, axis=0).max()
+    rng = np.random.RandomState(0)
+    reference.co = reference.co + (rng.random_sample(reference.co.shape) - 0.5) * size * 0.01
+    reference.add_pin(reference.co[0] + size * 0.05, 0, stiffness=springs, twisty=True, x_mirr=x_mirror)
+    start = get_backend_class(REFERENCE_BACKEND)(source_bm, target_bm, max_springs, x_mirror, 6)
+    _copy_state(reference, start)
+
+    results = []
+    for name in backend_names():
+        if name == REFERENCE_BACKEND:
+            continue
+        engine_cls = get_backend_class(name)
+        if engine_cls is None:
+            results.append((name, "unavailable", None, None))
+            continue
+
+        try:
+            engine = engine_cls(source_bm, target_bm, max_springs, x_mirror, 6)
+        except TypeError as e:
+            results.append((name, f"incompatible constructor ({e})", None, None))
+            continue
+        missing = missing_members(engine)
+        if missing:
+            results.append((name, "missing " + ", ".join(missing), None, None))
+            continue
+        engine.add_pin(reference.co[0] + size * 0.05, 0, stiffness=springs, twisty=True, x_mirr=x_mirror)
+
+        ref_stages = _stages(reference, springs)
+        for (stage_name, ref_stage), (_, stage) in zip(ref_stages, _stages(engine, springs)):
+            if stage_name == "target_attract" and not target_bm:
+                continue
+            _copy_state(start, reference)
+            _copy_state(start, engine)
+            ref_stage()
+            stage()
+            error = np.abs(np.asarray(engine.co) - reference.co).max() / size
+            status = "ok" if error <= tolerance else "FAILED"
+            speedup = _timed(ref_stage, reference, start) / max(_timed(stage, engine, start), 1e-9)
+            results.append((name, status, stage_name, (error, speedup)))
+    return results
+
+
+@register_class
+class BackendTest(bpy.types.Operator):
+    bl_idname = "softwrap.backend_test"
+    bl_label = "backend conformance test"
+    bl_description = "Compares every registered backend against the reference engine"
+    bl_options = {"REGISTER"}
+
+    @classmethod
+    def poll(cls, context):
+        return context.active_object and context.active_object.type == "MESH"
+
+    def execute(self, context):
+        settings = get_settings(context)
+        source_bm = bmesh.new()
+        source_bm.from_mesh(context.active_object.data)
+        target_bm = None
+        if settings.target_mesh:
+            target_bm = bmesh.new()
+            target_bm.from_mesh(settings.target_mesh.data)
+
+        failed = False
+        compared = 0
+        for name, status, stage_name, values in run_conformance(source_bm, target_bm):
+            if values is None:
+                print(f"{name}: {status}")
+                continue
+            compared += 1
+            error, speedup = values
+            failed = failed or status != "ok"
+            print(f"{name}.{stage_name}: {status}, error {error:.2e}, {speedup:.2f}x reference speed")
+
+        source_bm.free()
+        if target_bm:
+            target_bm.free()
+
+        if failed:
+            self.report({"WARNING"}, message="Backend conformance failed, see console")
+        elif not compared:
+            self.report({"WARNING"}, message="No backend was available to compare, see console")
+        else:
+            self.report({"INFO"}, message="Backend conformance passed, see console")
+        return {"FINISHED"}
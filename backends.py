@@ -0,0 +1,88 @@
+'''
+Engine backends.
+
+A backend is a class constructed like springs.SpringEngine:
+    Backend(source_bm, target_bm, max_springs, x_mirror, immediate_edges_max, progressive=False, storage_dir=None,
+            mesh=None)
+exposing the attributes in BACKEND_ATTRIBUTES and the methods in BACKEND_METHODS.
+With progressive=True the constructor may return a partially built engine, init_step() finishes
+it in time slices and init_progress reaches 1 when it's done. Backends that build everything
+at once can ignore the flag and keep init_progress at 1.
+storage_dir is a directory for memory mapped spring tables ("" for the system temp directory),
+None keeps everything in memory. Backends without an out of core mode may ignore it.
+mesh, also passed to rebuild(), is the Mesh the bmesh was read from so its data can be read
+with foreach_get instead of per element, None when there is no such mesh.
+The numpy SpringEngine is the reference, faster kernels are opt-ins registered with add_backend()
+and checked against it with backend_test.py.
+
+Backend classes are resolved lazily by module name, so this module stays free of numpy.
+'''
+
+from .multifile import load_module
+
+BACKEND_ATTRIBUTES = ("n", "co", "last_co", "bm", "pins", "sizing", "weighted_sampling", "max_springs",
+                      "init_progress", "index_map")
+
+BACKEND_METHODS = ("springs_force_apply",
+                   "implicit_solve",
+                   "smooth",
+                   "target_attract",
+                   "movement_step",
+                   "x_mirror_apply",
+                   "repulsion_apply",
+                   "add_pin",
+                   "clear_pins",
+                   "pins_apply",
+                   "history_setup",
+                   "history_nbytes",
+                   "snapshot",
+                   "rewind",
+                   "topology_changed",
+                   "rebuild",
+                   "vertex_normals",
+                   "memory_usage",
+                   "moved",
+                   "back_to_bm",
+                   "init_step")
+
+REFERENCE_BACKEND = "NUMPY"
+
+_backends = {}
+_enum_items = []
+
+
+def add_backend(name, label, description, module_name, class_name):
+    _backends[name] = (module_name, class_name)
+    # Blender needs the enum items to stay alive, so the same list is updated in place.
+    _enum_items[:] = [item for item in _enum_items if item[0] != name]
+    _enum_items.append((name, label, description))
+
+
+def backend_items(self, context):
+    return _enum_items
+
+
+def backend_names():
+    return list(_backends.keys())
+
+
+def missing_members(engine):
+    return [member for member in BACKEND_ATTRIBUTES + BACKEND_METHODS if not hasattr(engine, member)]
+
+
+def get_backend_class(name):
+    # Returns None when the backend is unknown or its module can't be imported (eg. a missing compiled module).
+    if name not in _backends:
+        return None
+    module_name, class_name = _backends[name]
+    try:
+        module = load_module(module_name)
+    except ImportError as e:
+        print("Softwrap backend", name, "unavailable:", e)
+        return None
+    return getattr(module, class_name, None)
+
+
+add_backend(REFERENCE_BACKEND, "Numpy", "Reference engine written with numpy", "springs", "SpringEngine")
+add_backend("CORE", "Compiled Core", "Compiled softwrap_core engine, reported unavailable when the module isn't built",
+            "softwrap_core", "ShapeEngine")
@@ -0,0 +1,244 @@
+'''
+Development benchmarks, run them from the operator search with the module added in __init__.py.
+They build synthetic meshes, so they don't depend on the scene content and also run headless:
+    blender -b --python-expr "import bpy; bpy.ops.softwrap.soak_test()"
+'''
+
+import bpy
+import bmesh
+import gc
+import gpu
+import os
+import time
+import tracemalloc
+from .multifile import register_class, load_module
+from .interface import get_settings
+from .utils import DummyObj
+
+
+def grid_bm(size=100):
+    bm = bmesh.new()
+    bmesh.ops.create_grid(bm, x_segments=size, y_segments=size, size=1)
+    bm.verts.ensure_lookup_table()
+    return bm
+
+
+def _attribute_reads(pins, ticks):
+    t = time.perf_counter()
+    for tick in range(ticks):
+        for pin in pins:
+            pin.vert_index, pin.stiffness, pin.factor, pin.twisty, pin.co
+    return (time.perf_counter() - t) / ticks
+
+
+def pins_benchmark(pin_counts=(10, 100, 1000, 5000), ticks=50, grid_size=100):
+    # Per tick pins_apply time, and the attribute reads it does per pin on slotted records
+    # against the dict backed DummyObj they replaced.
+    springs = load_module("springs")
+    bm = grid_bm(grid_size)
+    engine = springs.SpringEngine(bm, None, 50, False, 6)
+    results = []
+    for count in pin_counts:
+        engine.clear_pins()
+        for i in range(count):
+            index = (i * 7919) % engine.n
+            engine.add_pin(engine.co[index], index, stiffness=20, twisty=bool(i % 2))
+
+        t = time.perf_counter()
+        for tick in range(ticks):
+            engine.pins_apply()
+        apply_time = (time.perf_counter() - t) / ticks
+
+        dummies = [DummyObj(co=pin.co, vert_index=pin.vert_index, stiffness=pin.stiffness,
+                            factor=pin.factor, twisty=pin.twisty) for pin in engine.pins]
+        results.append((count, apply_time, _attribute_reads(dummies, ticks), _attribute_reads(engine.pins, ticks)))
+    bm.free()
+    return results
+
+
+@register_class
+class PinsBenchmark(bpy.types.Operator):
+    bl_idname = "softwrap.benchmark_pins"
+    bl_label = "benchmark pins"
+    bl_description = "Times pins_apply and pin record access at increasing pin counts"
+    bl_options = {"REGISTER"}
+
+    def execute(self, context):
+        for count, apply_time, dict_time, slots_time in pins_benchmark():
+            print(f"{count} pins: pins_apply {apply_time * 1000:.3f} ms/tick, "
+                  f"reads DummyObj {dict_time * 1e6:.1f} us, slotted {slots_time * 1e6:.1f} us")
+        self.report({"INFO"}, message="Benchmark done, see console")
+        return {"FINISHED"}
+
+
+def block_size_benchmark(block_sizes=(256, 1024, 4096, 16384, 65536), ticks=10, grid_size=300,
+                         max_springs=100, quality=25, storage_dir=""):
+    # springs_force_apply throughput in vertices per second against block_size,
+    # with the spring tables in memory and memory mapped in storage_dir.
+    springs = load_module("springs")
+    bm = grid_bm(grid_size)
+    results = []
+    for storage in (None, storage_dir):
+        engine = springs.SpringEngine(bm, None, max_springs, False, 6, storage_dir=storage)
+        for block_size in block_sizes:
+            engine.block_size = block_size
+            engine.out_cache.springs_ids = None
+            t = time.perf_counter()
+            engine.springs_force_apply(factor=0.9, stiffness=max_springs, springs=quality)
+            sample_time = time.perf_counter() - t
+
+            t = time.perf_counter()
+            for tick in range(ticks):
+                engine.springs_force_apply(factor=0.9, stiffness=max_springs, springs=quality)
+            step_time = (time.perf_counter() - t) / ticks
+            results.append((storage is not None, block_size, engine.n / sample_time, engine.n / step_time))
+        del engine
+    bm.free()
+    return results
+
+
+@register_class
+class BlockSizeBenchmark(bpy.types.Operator):
+    bl_idname = "softwrap.benchmark_block_size"
+    bl_label = "benchmark block size"
+    bl_description = "Times the streamed spring kernels at several block sizes, in memory and out of core"
+    bl_options = {"REGISTER"}
+
+    def execute(self, context):
+        for mapped, block_size, sample_rate, step_rate in block_size_benchmark():
+            print(f"{'mapped' if mapped else 'memory'} block {block_size}: "
+                  f"sampling {sample_rate / 1e6:.2f} Mverts/s, step {step_rate / 1e6:.2f} Mverts/s")
+        self.report({"INFO"}, message="Benchmark done, see console")
+        return {"FINISHED"}
+
+
+def _rss():
+    # Resident set size in bytes, None where /proc isn't available.
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _grid_object(context, name, size):
+    mesh = bpy.data.meshes.new(name)
+    bm = grid_bm(size)
+    bm.to_mesh(mesh)
+    bm.free()
+    ob = bpy.data.objects.new(name, mesh)
+    context.scene.collection.objects.link(ob)
+    return ob
+
+
+def _offscreen():
+    # None without a GPU context, like blender -b.
+    try:
+        return gpu.types.GPUOffScreen(64, 64)
+    except Exception:
+        return None
+
+
+def soak_test(context, cycles=200, steps=5, grid_size=50, warmup=10):
+    # Runs Start/step/Stop cycles of CurrEngine, plus standalone SpringEngine and DrawCallback
+    # lifetimes, and measures what is retained after the warmup cycles.
+    # DrawCallback batches are only built when drawing, so they are drawn into an offscreen buffer.
+    # Headless there's no GPU context and only the Python side of DrawCallback is exercised.
+    # GPU memory is invisible to tracemalloc and to the rss of most drivers either way.
+    # Returns (traced bytes grown, rss bytes grown or None, top allocation differences, batches drawn).
+    from .manager import CurrEngine
+    springs = load_module("springs")
+    draw_3d = load_module("draw_3d")
+    settings = get_settings(context)
+    saved = settings.source_mesh, settings.target_mesh
+    source = _grid_object(context, "softwrap_soak_source", grid_size)
+    target = _grid_object(context, "softwrap_soak_target", grid_size * 2)
+    settings.source_mesh = source
+    settings.target_mesh = target
+    offscreen = _offscreen()
+
+    tracemalloc.start()
+    try:
+        for cycle in range(cycles):
+            CurrEngine.init()
+            # Finish a progressive build so the full tables, mirror and target data are exercised too.
+            CurrEngine.init_step(settings, None)
+            for step in range(steps):
+                CurrEngine.pins_update(context, None)
+                CurrEngine.step()
+                CurrEngine.write_back(settings, force=True)
+                CurrEngine.draw(context)
+            CurrEngine.remove(context)
+
+            bm = grid_bm(grid_size)
+            engine = springs.SpringEngine(bm, None, 50, True, 6)
+            engine.springs_force_apply(factor=0.9, stiffness=30, springs=10)
+            engine.add_pin(engine.co[0], 0, twisty=True)
+            engine.pins_apply()
+            del engine
+            bm.free()
+
+            callback = draw_3d.DrawCallback()
+            callback.add_line((0, 0, 0), (1, 1, 1))
+            callback.add_point((0, 0, 0))
+            callback.update_batch()
+            if offscreen:
+                with offscreen.bind():
+                    callback._draw()
+                callback.free_batches()
+            del callback
+
+            if cycle == warmup - 1:
+                gc.collect()
+                base = tracemalloc.take_snapshot()
+                base_traced = tracemalloc.get_traced_memory()[0]
+                base_rss = _rss()
+
+        gc.collect()
+        final = tracemalloc.take_snapshot()
+        traced = tracemalloc.get_traced_memory()[0] - base_traced
+        rss = _rss()
+        rss = rss - base_rss if rss is not None and base_rss is not None else None
+        top = final.compare_to(base, "lineno")[:10]
+    finally:
+        tracemalloc.stop()
+        if offscreen:
+            offscreen.free()
+        settings.source_mesh, settings.target_mesh = saved
+        for ob in (source, target):
+            mesh = ob.data
+            bpy.data.objects.remove(ob)
+            bpy.data.meshes.remove(mesh)
+    return traced, rss, top, offscreen is not None
+
+
+@register_class
+class SoakTest(bpy.types.Operator):
+    bl_idname = "softwrap.soak_test"
+    bl_label = "soak test"
+    bl_description = "Starts and stops the engine many times and fails if retained memory grows"
+    bl_options = {"REGISTER"}
+
+    cycles: bpy.props.IntProperty(name="Cycles", min=20, default=200)
+    # Allowed growth after the warmup, rss is looser since the allocator keeps freed pages around.
+    traced_tolerance = 2 ** 20
+    rss_tolerance = 32 * 2 ** 20
+
+    def execute(self, context):
+        if get_settings(context).is_running:
+            self.report({"WARNING"}, message="Stop Softwrap before running the soak test")
+            return {"CANCELLED"}
+
+        traced, rss, top, drawn = soak_test(context, cycles=self.cycles)
+        for stat in top:
+            print(stat)
+        if not drawn:
+            print("Soak test: no GPU context, DrawCallback batches were not built")
+        rss_text = f"{rss / 2 ** 20:.2f} MB" if rss is not None else "unavailable"
+        print(f"Soak test: traced growth {traced / 2 ** 20:.2f} MB, rss growth {rss_text}")
+
+        if traced > self.traced_tolerance or (rss is not None and rss > self.rss_tolerance):
+            self.report({"ERROR"}, message="Soak test failed, memory keeps growing, see console")
+            return {"CANCELLED"}
+        self.report({"INFO"}, message="Soak test passed, see console")
+        return {"FINISHED"}
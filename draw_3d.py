@@ -16,9 +16,9 @@ __all__ = ["DrawCallback",
 import bpy
 import bgl
 import gpu
-from gpu_extras.batch import batch_for_shader
 from mathutils import Matrix, Vector
 import blf
+from .tracing import traced
 
 # Blend Modes
 BLEND = 0
@@ -93,6 +93,68 @@ void main()
 }   
 """
 
+# Compiled programs are shared by every DrawCallback, each is compiled once on its first draw.
+_shader_sources = {"LINES": (vertex_shader, fragment_shader),
+                   "POINTS": (point_vertex_shader, point_fragment_shader)}
+_shaders = {}
+
+
+def get_shader(primitive):
+    shader = _shaders.get(primitive, None)
+    if shader is None:
+        shader = gpu.types.GPUShader(*_shader_sources[primitive])
+        _shaders[primitive] = shader
+    return shader
+
+
+class _BatchLayer:
+    # Keeps the vertex buffer and batch of one primitive type. A static vertex buffer can't be
+    # refilled once drawn, so new data builds a new one and unchanged data keeps the old batch.
+    def __init__(self, primitive):
+        self.primitive = primitive
+        self.coords = []
+        self.colors = []
+        self.dirty = False
+        self._vbo = None
+        self._batch = None
+
+    def set_data(self, coords, colors):
+        if not self.dirty and self._batch is not None and coords == self.coords and colors == self.colors:
+            return
+        self.coords = coords
+        self.colors = colors
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.coords)
+
+    def free(self):
+        self.coords = []
+        self.colors = []
+        self.dirty = False
+        self._vbo = None
+        self._batch = None
+
+    def _build(self, shader):
+        fmt = gpu.types.GPUVertFormat()
+        fmt.attr_add(id="pos", comp_type="F32", len=3, fetch_mode="FLOAT")
+        fmt.attr_add(id="color", comp_type="F32", len=4, fetch_mode="FLOAT")
+        self._vbo = gpu.types.GPUVertBuf(len=len(self.coords), format=fmt)
+        self._vbo.attr_fill(id="pos", data=self.coords)
+        self._vbo.attr_fill(id="color", data=self.colors)
+        self._batch = gpu.types.GPUBatch(type=self.primitive, buf=self._vbo)
+        self._batch.program_set(shader)
+        self.dirty = False
+
+    def draw(self):
+        if not self.coords:
+            return
+        shader = get_shader(self.primitive)
+        if self.dirty:
+            self._build(shader)
+        shader.bind()
+        self._batch.draw(shader)
+
 
 class DrawCallback:
     def __init__(self):
@@ -114,12 +176,8 @@ class DrawCallback:
         self.texts = []
         self.point_coords = []
         self.point_colors = []
-        self._line_shader = gpu.types.GPUShader(vertex_shader, fragment_shader)
-        self._point_shader = gpu.types.GPUShader(point_vertex_shader, point_fragment_shader)
-        self._line_batch = batch_for_shader(self._line_shader, 'LINES',
-                                            {"pos": self.line_coords, "color": self.line_colors})
-        self._point_batch = batch_for_shader(self._line_shader, 'POINTS',
-                                             {"pos": self.point_coords, "color": self.line_colors})
+        self._line_layer = _BatchLayer("LINES")
+        self._point_layer = _BatchLayer("POINTS")
 
     def __call__(self, *args, **kwargs):
         # __call__ Makes this object behave like a function.
@@ -140,11 +198,12 @@ class DrawCallback:
     def update_batch(self):
         # This takes the data rebuilds the shader batch.
         # Call it every time you clear the data or add new lines, otherwize,
-        # You wont see changes in the viewport
-        coords = [self.matrix @ Vector(coord) for coord in self.line_coords]
-        self._line_batch = batch_for_shader(self._line_shader, 'LINES', {"pos": coords, "color": self.line_colors})
-        coords = [self.matrix @ Vector(coord) for coord in self.point_coords]
-        self._point_batch = batch_for_shader(self._point_shader, 'POINTS', {"pos": coords, "color": self.point_colors})
+        # You wont see changes in the viewport.
+        # GPU buffers are only built on the next draw, and kept if the data didn't change.
+        coords = [tuple(self.matrix @ Vector(coord)) for coord in self.line_coords]
+        self._line_layer.set_data(coords, list(self.line_colors))
+        coords = [tuple(self.matrix @ Vector(coord)) for coord in self.point_coords]
+        self._point_layer.set_data(coords, list(self.point_colors))
 
     def add_line(self, start, end, color1=(1, 0, 0, 1), color2=None):
         # Simple add_line function, support color gradients,
@@ -179,6 +238,11 @@ class DrawCallback:
         self.point_colors.clear()
         self.texts.clear()
 
+    def free_batches(self):
+        # Drops the GPU buffers, they are rebuilt on the next draw after update_batch()
+        self._line_layer.free()
+        self._point_layer.free()
+
     def _start_drawing(self):
         # This handles all the settings of the renderer before starting the draw stuff
 
@@ -208,6 +272,7 @@ class DrawCallback:
         if not self.draw_on_top:
             bgl.glDisable(bgl.GL_DEPTH_TEST)
 
+    @traced("viewport_draw")
     def _draw(self):
         # This should be called by __call__,
         # just regular routines for rendering in the viewport as a draw_handler
@@ -215,18 +280,22 @@ class DrawCallback:
         ui_scale = bpy.context.preferences.system.ui_scale
         font_id = 0
 
+        if not (self.texts or self._line_layer or self._point_layer):
+            return
+
         for txt in self.texts:
             blf.position(font_id, *txt["co"], 0)
             blf.size(font_id, int(txt["size"] * ui_scale), dpi)
             blf.color(font_id, *txt["color"])
             blf.draw(font_id, txt["text"])
 
+        if not (self._line_layer or self._point_layer):
+            return
+
         self._start_drawing()
 
-        self._line_shader.bind()
-        self._line_batch.draw(self._line_shader)
-        self._point_shader.bind()
-        self._point_batch.draw(self._point_shader)
+        self._line_layer.draw()
+        self._point_layer.draw()
 
         self._stop_drawing()
 
@@ -0,0 +1,90 @@
+import numpy as np
+from collections import deque
+
+
+class SnapshotRing:
+    '''
+    Bounded history of engine states (co, last_co).
+
+    Snapshots are grouped behind a full precision keyframe, the others only store their
+    difference to that keyframe, optionally as float16. Residuals are taken against the keyframe
+    instead of the previous snapshot so the float16 rounding error doesn't accumulate.
+    The oldest groups are dropped as a whole to stay within max_bytes. When the newest group alone
+    can't grow within it, a new keyframe group is started instead, so max_bytes is never exceeded.
+    '''
+
+    def __init__(self, max_bytes=64 * 2 ** 20, keyframe_interval=16, half_precision=True):
+        self.max_bytes = max_bytes
+        self.keyframe_interval = keyframe_interval
+        self.residual_dtype = np.float16 if half_precision else np.float32
+        self.groups = deque()
+        self.nbytes = 0
+
+    def __len__(self):
+        return sum(1 + len(group[2]) for group in self.groups)
+
+    @staticmethod
+    def _group_nbytes(group):
+        key_co, key_last_co, residuals = group
+        return key_co.nbytes + key_last_co.nbytes + sum(dco.nbytes + dlast.nbytes for dco, dlast in residuals)
+
+    def _evict(self, incoming, keep):
+        # Drops the oldest groups, but keep of them, until incoming more bytes fit.
+        while len(self.groups) > keep and self.nbytes + incoming > self.max_bytes:
+            self.nbytes -= self._group_nbytes(self.groups.popleft())
+
+    def push(self, co, last_co):
+        key_bytes = co.nbytes + last_co.nbytes
+        if key_bytes > self.max_bytes:
+            # Not even one state fits.
+            self.clear()
+            return
+
+        extend = self.groups and len(self.groups[-1][2]) < self.keyframe_interval - 1 \
+            and self.groups[-1][0].shape == co.shape
+        if extend:
+            residual_bytes = (co.size + last_co.size) * np.dtype(self.residual_dtype).itemsize
+            self._evict(residual_bytes, keep=1)
+            extend = self.nbytes + residual_bytes <= self.max_bytes
+
+        if extend:
+            key_co, key_last_co, residuals = self.groups[-1]
+            dco = (co - key_co).astype(self.residual_dtype)
+            dlast = (last_co - key_last_co).astype(self.residual_dtype)
+            residuals.append((dco, dlast))
+            self.nbytes += dco.nbytes + dlast.nbytes
+        else:
+            self._evict(key_bytes, keep=0)
+            group = (co.copy(), last_co.copy(), [])
+            self.groups.append(group)
+            self.nbytes += self._group_nbytes(group)
+
+    def rewind(self, ticks):
+        # Drops the last ticks snapshots and returns the state of the newest remaining one,
+        # the oldest snapshot is returned if the history is shorter than that.
+        # Returns None when the history is empty.
+        if not self.groups:
+            return None
+
+        ticks = min(max(ticks, 0), len(self) - 1)
+        while ticks > 0:
+            residuals = self.groups[-1][2]
+            if residuals:
+                drop = min(ticks, len(residuals))
+                for dco, dlast in residuals[-drop:]:
+                    self.nbytes -= dco.nbytes + dlast.nbytes
+                del residuals[-drop:]
+                ticks -= drop
+            else:
+                self.nbytes -= self._group_nbytes(self.groups.pop())
+                ticks -= 1
+
+        key_co, key_last_co, residuals = self.groups[-1]
+        if residuals:
+            dco, dlast = residuals[-1]
+            return key_co + dco, key_last_co + dlast
+        return key_co.copy(), key_last_co.copy()
+
+    def clear(self):
+        self.groups.clear()
+        self.nbytes = 0
@@ -1,5 +1,27 @@
 import bpy
+import os
+import tempfile
 from .multifile import register_class, register_function, unregister_function
+from .backends import backend_items
+from .memory import estimate_memory
+from . import tracing
+
+
+def trace_path(settings):
+    if settings.trace_path:
+        return bpy.path.abspath(settings.trace_path)
+    return os.path.join(tempfile.gettempdir(), "softwrap_trace.json")
+
+
+def _trace_update(self, context):
+    if self.trace_enabled:
+        tracing.start()
+        return
+    path = trace_path(self)
+    try:
+        print("Softwrap: wrote", tracing.stop(path), "trace events to", path)
+    except OSError as e:
+        print("Softwrap: could not write the trace,", e)
 
 
 @register_class
@@ -19,7 +41,31 @@ class SoftWrapSettings(bpy.types.PropertyGroup):
                                                        "choose the side not assigned as selection")
 
     max_springs: bpy.props.IntProperty(name="Max Springs", min=4, default=300)
+    memory_budget: bpy.props.IntProperty(
+        name="Memory Budget (MB)", min=0, default=0,
+        description="Clamp Max Springs and Quality on Start so the engine fits in this budget, 0 disables it")
+    engine_memory: bpy.props.FloatProperty(
+        default=0, options={"SKIP_SAVE", "HIDDEN"})
+    quality_limit: bpy.props.IntProperty(
+        default=0, options={"SKIP_SAVE", "HIDDEN"})
+    budget_needed: bpy.props.FloatProperty(
+        default=0, options={"SKIP_SAVE", "HIDDEN"})
+    backend: bpy.props.EnumProperty(name="Backend", items=backend_items,
+                                    description="Engine implementation used on Start")
     x_mirror: bpy.props.BoolProperty(name="X Mirror", default=False)
+    out_of_core: bpy.props.BoolProperty(
+        name="Out of Core", default=False,
+        description="Keep the spring tables in memory mapped files, "
+                    "slower but lets very large meshes run without running out of memory")
+    storage_dir: bpy.props.StringProperty(
+        name="Storage", subtype="DIR_PATH", default="",
+        description="Directory of the out of core files, empty uses the system temporary directory")
+    progressive_init: bpy.props.BoolProperty(
+        name="Progressive Start", default=True,
+        description="Start simulating on the first ring of springs right away "
+                    "and build the full springs in the background")
+    init_progress: bpy.props.FloatProperty(
+        default=1, options={"SKIP_SAVE", "HIDDEN"})
     source_mesh: bpy.props.PointerProperty(
         type=bpy.types.Object, name="Source Mesh")
     target_mesh: bpy.props.PointerProperty(
@@ -31,22 +77,75 @@ class SoftWrapSettings(bpy.types.PropertyGroup):
         name="Smooth", min=0, max=5, default=0)
     tension: bpy.props.FloatProperty(name="Tension", min=0, max=1, default=0.99)
     iterations: bpy.props.IntProperty(name="Iterations", min=1, default=2)
+    solver: bpy.props.EnumProperty(name="Solver",
+                                   items=(("EXPLICIT", "Explicit", "Averages sampled springs, cheap per iteration "
+                                                                   "but needs many iterations to look stiff"),
+                                          ("IMPLICIT", "Implicit", "Solves the spring system with conjugate "
+                                                                   "gradients, stiff with few iterations")),
+                                   default="EXPLICIT")
+    cg_iterations: bpy.props.IntProperty(name="Solver Iterations", min=1, default=8)
     quality: bpy.props.IntProperty(name="Quality", min=4, default=25)
+    adaptive_quality: bpy.props.BoolProperty(
+        name="Adaptive Quality", default=True,
+        description="Trade accuracy for responsiveness while grabbing, full quality returns after release")
+    grab_quality: bpy.props.IntProperty(name="Grab Quality", min=4, default=8)
+    grab_iterations: bpy.props.IntProperty(name="Grab Iterations", min=1, default=1)
+    settle_ticks: bpy.props.IntProperty(
+        name="Settle Ticks", min=0, default=10,
+        description="Steps taken to ramp back to full quality after the mouse is released")
+    weighted_sampling: bpy.props.BoolProperty(
+        name="Distance Weighted", default=False,
+        description="Sample closer springs more often when Quality is lower than Stiffness")
+    self_collision: bpy.props.FloatProperty(
+        name="Self Collision", min=0, max=1, default=0)
+    collision_distance: bpy.props.FloatProperty(
+        name="Collision Distance", min=0, max=2, default=0.5)
 
     target_attraction: bpy.props.FloatProperty(
         name="Target Forcce", min=0, max=1, default=0.5)
     scale: bpy.props.FloatProperty(name="Scale", min=0, default=1, step=0.01)
+    update_rate: bpy.props.FloatProperty(
+        name="Mesh Update Rate", min=0, default=30,
+        description="Maximum mesh updates per second, the simulation keeps stepping in between. "
+                    "0 updates the mesh after every step")
 
     pin_stiffness: bpy.props.IntProperty(
         name="Pin Stiffness", min=0, default=30)
     pin_force: bpy.props.FloatProperty(
         name="Pin Force", min=0, max=1, default=1)
 
+    history_size: bpy.props.IntProperty(
+        name="History (MB)", min=0, default=64,
+        description="Memory used to keep past simulation states for rewinding, 0 disables it")
+    history_half_precision: bpy.props.BoolProperty(
+        name="Half Precision History", default=True,
+        description="Store history residuals as float16, halves the memory at a small precision cost")
+    rewind_ticks: bpy.props.IntProperty(name="Rewind Ticks", min=1, default=50)
+    history_memory: bpy.props.FloatProperty(
+        default=0, options={"SKIP_SAVE", "HIDDEN"})
+
+    trace_enabled: bpy.props.BoolProperty(
+        name="Record Trace", default=False, options={"SKIP_SAVE"}, update=_trace_update,
+        description="Record the timing of every stage, the trace is written when recording is turned off")
+    trace_path: bpy.props.StringProperty(
+        name="Trace File", subtype="FILE_PATH", default="",
+        description="Chrome trace JSON output, opens in chrome://tracing or Perfetto. "
+                    "Empty writes softwrap_trace.json in the system temporary directory")
+
 
 def get_settings(context):
     return context.scene.softwrap_settings
 
 
+def estimate_kwargs(settings):
+    # estimate_memory() and fit_budget() options matching what Start will enable.
+    return {"x_mirror": settings.x_mirror,
+            "implicit": settings.solver == "IMPLICIT",
+            "out_of_core": settings.out_of_core,
+            "self_collision": settings.self_collision > 0,
+            "history_bytes": settings.history_size * 2 ** 20}
+
+
 @register_class
 class SoftWrapPanel(bpy.types.Panel):
     bl_idname = "SOFTWRAP_PT_softwrap_panel"
@@ -78,7 +177,25 @@ class SoftWrapPanel(bpy.types.Panel):
             layout.operator("softwrap.main", text="Start")
 
         layout.prop(settings, "max_springs")
+        layout.prop(settings, "memory_budget")
+        if settings.is_running:
+            if settings.init_progress < 1:
+                layout.label(text=f"Building springs: {settings.init_progress * 100:.0f}%")
+            layout.label(text=f"Engine memory: {settings.engine_memory:.1f} MB")
+            if 0 < settings.quality_limit < settings.quality:
+                layout.label(text=f"Quality limited to {settings.quality_limit} by the budget")
+            if settings.budget_needed > 0:
+                layout.label(text=f"Budget too small, needs at least {settings.budget_needed:.0f} MB", icon="ERROR")
+        elif settings.source_mesh and settings.source_mesh.type == "MESH":
+            persistent, peak = estimate_memory(len(settings.source_mesh.data.vertices), settings.max_springs,
+                                               settings.quality, settings.stiffness, **estimate_kwargs(settings))
+            layout.label(text=f"Estimated memory: {persistent / 2 ** 20:.1f} + {peak / 2 ** 20:.1f} MB peak")
+        layout.prop(settings, "backend")
         layout.prop(settings, "x_mirror")
+        layout.prop(settings, "progressive_init")
+        layout.prop(settings, "out_of_core")
+        if settings.out_of_core:
+            layout.prop(settings, "storage_dir")
 
         layout.separator()
         layout.prop(settings, "source_mesh")
@@ -86,17 +203,31 @@ class SoftWrapPanel(bpy.types.Panel):
 
         layout.separator()
         layout.label(text="Dynamics")
+        layout.prop(settings, "solver", expand=True)
+        if settings.solver == "IMPLICIT":
+            layout.prop(settings, "cg_iterations")
         layout.prop(settings, "stiffness")
         layout.prop(settings, "drag", slider=True)
         layout.prop(settings, "smoothing", slider=True)
         layout.prop(settings, "tension")
         layout.prop(settings, "iterations")
         layout.prop(settings, "quality")
+        layout.prop(settings, "weighted_sampling")
+        layout.prop(settings, "adaptive_quality")
+        if settings.adaptive_quality:
+            col = layout.column(align=True)
+            col.prop(settings, "grab_quality")
+            col.prop(settings, "grab_iterations")
+            col.prop(settings, "settle_ticks")
+        layout.prop(settings, "self_collision", slider=True)
+        if settings.self_collision > 0:
+            layout.prop(settings, "collision_distance")
 
         layout.separator()
         layout.label(text="Retopo")
         layout.prop(settings, "target_attraction", slider=True)
         layout.prop(settings, "scale")
+        layout.prop(settings, "update_rate")
 
         ob = context.active_object
         pin_selected = ob and\
@@ -118,6 +249,22 @@ class SoftWrapPanel(bpy.types.Panel):
         else:
             layout.label(text="No pin selected")
 
+        layout.separator()
+        layout.label(text="History")
+        row = layout.row(align=True)
+        row.prop(settings, "history_size")
+        row.prop(settings, "history_half_precision", text="", icon="FILE_TICK")
+        if settings.is_running:
+            row = layout.row(align=True)
+            row.operator("softwrap.rewind").ticks = settings.rewind_ticks
+            row.prop(settings, "rewind_ticks", text="Ticks")
+            layout.label(text=f"History memory: {settings.history_memory:.1f} MB")
+
+        layout.separator()
+        layout.label(text="Profiling")
+        layout.prop(settings, "trace_enabled", toggle=True)
+        layout.prop(settings, "trace_path")
+
 
 @register_function
 def register():
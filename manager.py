@@ -1,21 +1,39 @@
 import bpy
 import bmesh
-
-from .springs import SpringEngine
+import time
 
 from mathutils.geometry import intersect_line_plane
 from mathutils import Matrix, Vector
 from bpy_extras.view3d_utils import region_2d_to_origin_3d, region_2d_to_vector_3d, location_3d_to_region_2d
-from .utils import DummyObj
-from .multifile import register_class
-from .interface import get_settings
-from .draw_3d import DrawCallback, MULTIPLY_BLEND
+from .utils import MousePin
+from .multifile import register_class, load_module
+from .interface import get_settings, estimate_kwargs
+from .backends import get_backend_class, REFERENCE_BACKEND
+from .memory import fit_budget, estimate_memory
+from .tracing import span, traced
+
+# springs and draw_3d pull in numpy and gpu, they are only loaded on the first Start.
+draw = None
+
+
+def setup_draw():
+    global draw
+    if draw is None:
+        draw_3d = load_module("draw_3d")
+        draw = draw_3d.DrawCallback()
+        draw.blend_mode = draw_3d.MULTIPLY_BLEND
+        draw.line_width = 2
+        draw.point_size = 10
+        draw.draw_on_top = True
+    return draw
+
 
-draw = DrawCallback()
-draw.blend_mode = MULTIPLY_BLEND
-draw.line_width = 2
-draw.point_size = 10
-draw.draw_on_top = True
+def set_if_changed(settings, name, value, ndigits=1):
+    # Writing a scene property tags the scene for a depsgraph update, skip writes the panel can't show.
+    # Float properties are stored as float32, so the stored value is rounded too before comparing.
+    value = round(value, ndigits)
+    if round(getattr(settings, name), ndigits) != value:
+        setattr(settings, name, value)
 
 
 def get_mouse_ray(context, event, mat=Matrix.Identity(4)):
@@ -40,11 +58,86 @@ def global_to_screen(co, context):
     return location_3d_to_region_2d(region, r3d, co)
 
 
+class PinRegistry:
+    # Engine pins built from the pin empties, only rebuilt when a depsgraph update touches a pin,
+    # the source object transform, or objects are added or deleted.
+    dirty = True
+    names = set()
+    source_name = None
+    object_count = 0
+    x_mirror = False
+    static_count = 0
+
+    @classmethod
+    def depsgraph_update(cls, scene, depsgraph=None):
+        if depsgraph is None:
+            cls.dirty = True
+            return
+        for update in depsgraph.updates:
+            if not isinstance(update.id, bpy.types.Object):
+                continue
+            name = update.id.name
+            if name in cls.names or (name == cls.source_name and update.is_updated_transform):
+                cls.dirty = True
+                return
+
+    @classmethod
+    def setup(cls):
+        cls.dirty = True
+        if cls.depsgraph_update not in bpy.app.handlers.depsgraph_update_post:
+            bpy.app.handlers.depsgraph_update_post.append(cls.depsgraph_update)
+
+    @classmethod
+    def remove(cls):
+        if cls.depsgraph_update in bpy.app.handlers.depsgraph_update_post:
+            bpy.app.handlers.depsgraph_update_post.remove(cls.depsgraph_update)
+        cls.names = set()
+        cls.static_count = 0
+
+    @classmethod
+    def refresh(cls, context, engine, settings):
+        if len(context.scene.objects) != cls.object_count or settings.x_mirror != cls.x_mirror:
+            cls.dirty = True
+        if not cls.dirty:
+            return False
+
+        engine.clear_pins()
+        mat = settings.source_mesh.matrix_world.inverted()
+        names = set()
+        if settings.source_mesh.get("pins", None):
+            pins = list(settings.source_mesh["pins"])
+            for ob_name in list(pins):
+                if ob_name in context.scene.objects:
+                    ob = context.scene.objects[ob_name]
+                    co = mat @ ob.location
+                    engine.add_pin(co, ob["vert_index"], ob["stiffness"], ob["factor"], twisty=ob["twisty"],
+                                   x_mirr=settings.x_mirror)
+                    names.add(ob_name)
+                else:
+                    print("remove", ob_name)
+                    pins.remove(ob_name)
+            if len(pins) != len(settings.source_mesh["pins"]):
+                settings.source_mesh["pins"] = pins
+
+        cls.names = names
+        cls.source_name = settings.source_mesh.name
+        cls.object_count = len(context.scene.objects)
+        cls.x_mirror = settings.x_mirror
+        cls.static_count = len(engine.pins)
+        cls.dirty = False
+        return True
+
+
 class CurrEngine:
     engine = None
     source_bm = None
     target_bm = None
     mouse_pin = None
+    written_co = None
+    last_write = 0
+    last_memory_update = 0
+    last_mode = "OBJECT"
+    settle_left = 0
 
     @classmethod
     def init(cls):
@@ -63,19 +156,56 @@ class CurrEngine:
         else:
             cls.target_bm = None
 
-        cls.engine = SpringEngine(cls.source_bm, cls.target_bm, settings.max_springs, settings.x_mirror, 6)
-        draw.setup_handler()
+        engine_cls = get_backend_class(settings.backend)
+        if engine_cls is None:
+            print("Softwrap: falling back to the", REFERENCE_BACKEND, "backend")
+            engine_cls = get_backend_class(REFERENCE_BACKEND)
+
+        settings.quality_limit = 0
+        settings.budget_needed = 0
+        if settings.memory_budget > 0:
+            n = len(cls.source_bm.verts)
+            budget = settings.memory_budget * 2 ** 20
+            max_springs, quality = fit_budget(n, budget, settings.max_springs, settings.quality, settings.stiffness,
+                                              **estimate_kwargs(settings))
+            if max_springs < settings.max_springs:
+                print("Softwrap: Max Springs clamped to", max_springs, "by the memory budget")
+                settings.max_springs = max_springs
+            settings.quality_limit = quality
+            needed = sum(estimate_memory(n, max_springs, quality, min(settings.stiffness, max_springs),
+                                         **estimate_kwargs(settings)))
+            if needed > budget:
+                settings.budget_needed = needed / 2 ** 20
+                print(f"Softwrap: the memory budget can't be met, the lowest settings need {needed / 2 ** 20:.0f} MB")
+
+        cls.engine = engine_cls(cls.source_bm, cls.target_bm, settings.max_springs, settings.x_mirror, 6,
+                                progressive=settings.progressive_init,
+                                storage_dir=bpy.path.abspath(settings.storage_dir) if settings.out_of_core else None,
+                                mesh=settings.source_mesh.data)
+        settings.init_progress = cls.engine.init_progress
+        cls.memory_update(settings, force=True)
+        cls.written_co = cls.engine.co.copy()
+        cls.last_mode = settings.source_mesh.mode
+        setup_draw().setup_handler()
+        PinRegistry.setup()
 
     @classmethod
     def remove(cls, context):
         cls.engine = None
+        cls.written_co = None
+        cls.mouse_pin = None
+        cls.settle_left = 0
         if cls.source_bm:
             cls.source_bm.free()
             cls.source_bm = None
         if cls.target_bm:
             cls.target_bm.free()
             cls.target_bm = None
-        draw.remove_handler()
+        if draw:
+            draw.remove_handler()
+            draw.clear_data()
+            draw.free_batches()
+        PinRegistry.remove()
 
     @classmethod
     def mouse_pin_set(cls, context, event, mode="GRAB"):
@@ -84,10 +214,10 @@ class CurrEngine:
         if result:
             vert = min(cls.engine.bm.faces[index].verts, key=lambda v: (v.co - location).length_squared)
             if mode == "GRAB":
-                cls.mouse_pin = DummyObj(co=location,
-                                         normal=context.space_data.region_3d.view_rotation @ Vector((0, 0, 1)),
-                                         vert_index=vert.index,
-                                         d=vert.co - location)
+                cls.mouse_pin = MousePin(co=location,
+                                        normal=context.space_data.region_3d.view_rotation @ Vector((0, 0, 1)),
+                                        vert_index=vert.index,
+                                        d=vert.co - location)
                 return True
             elif mode == "PINS":
                 if settings.source_mesh.get("pins", None):
@@ -111,30 +241,65 @@ class CurrEngine:
                 context.view_layer.objects.active = ob
                 pinl.append(ob.name)
                 settings.source_mesh["pins"] = pinl
+                PinRegistry.dirty = True
                 return True
 
+    @classmethod
+    def topology_update(cls, context):
+        # Picks up topology edits of the source mesh, they land in the mesh data when leaving edit mode
+        # or straight away for object mode operators changing the element counts.
+        settings = get_settings(context)
+        ob = settings.source_mesh
+        left_edit, cls.last_mode = cls.last_mode != "OBJECT", ob.mode
+        if ob.mode != "OBJECT":
+            return
+        if not left_edit and len(ob.data.vertices) == cls.engine.n and \
+                len(ob.data.edges) == len(cls.engine.bm.edges):
+            return
+
+        bm = bmesh.new()
+        bm.from_mesh(ob.data)
+        if not cls.engine.topology_changed(bm):
+            bm.free()
+            return
+
+        cls.engine.rebuild(bm, cls.written_co, mesh=ob.data)
+        cls.source_bm.free()
+        cls.source_bm = bm
+        cls.written_co = cls.engine.co.copy()
+        cls.mouse_pin = None
+        cls.pins_remap(ob)
+        PinRegistry.dirty = True
+
+    @classmethod
+    def pins_remap(cls, ob):
+        index_map = cls.engine.index_map
+        mat = ob.matrix_world.inverted()
+        cls.source_bm.verts.ensure_lookup_table()
+        for ob_name in ob.get("pins", []):
+            pin = bpy.data.objects.get(ob_name, None)
+            if pin is None:
+                continue
+            index = pin["vert_index"]
+            index = index_map[index] if 0 <= index < len(index_map) else -1
+            if index < 0:
+                co = mat @ pin.location
+                index = min(cls.source_bm.verts, key=lambda v: (v.co - co).length_squared).index
+            pin["vert_index"] = int(index)
+
     @classmethod
     def mouse_pin_remove(cls):
         cls.mouse_pin = None
 
     @classmethod
+    @traced("pins_update")
     def pins_update(cls, context, event):
         settings = get_settings(context)
-        cls.engine.clear_pins()
-        mat = settings.source_mesh.matrix_world.inverted()
-        if settings.source_mesh.get("pins", None):
-            pins = list(settings.source_mesh["pins"])
-            for ob_name in pins:
-                if ob_name in context.scene.objects:
-                    ob = context.scene.objects[ob_name]
-                    co = mat @ ob.location
-                    cls.engine.add_pin(co, ob["vert_index"], ob["stiffness"], ob["factor"], twisty=ob["twisty"],
-                                       x_mirr=settings.x_mirror)
-                else:
-                    print("remove", ob_name)
-                    pins.remove(ob_name)
-            settings.source_mesh["pins"] = pins
+        PinRegistry.refresh(context, cls.engine, settings)
+        # Only the mouse pin changes every tick, it lives after the registry pins.
+        del cls.engine.pins[PinRegistry.static_count:]
         if cls.mouse_pin:
+            mat = settings.source_mesh.matrix_world.inverted()
             origin, vec = get_mouse_ray(context, event, mat)
             origin += cls.mouse_pin.d
             hit2 = intersect_line_plane(origin, origin + vec, cls.mouse_pin.co, cls.mouse_pin.normal)
@@ -142,6 +307,7 @@ class CurrEngine:
                                x_mirr=settings.x_mirror)
 
     @classmethod
+    @traced("draw")
     def draw(cls, context):
         settings = get_settings(context)
         draw.clear_data()
@@ -157,31 +323,139 @@ class CurrEngine:
         draw.update_batch()
 
     @classmethod
+    @traced("init_step")
+    def init_step(cls, settings, time_budget=0.02):
+        # Streams the rest of a progressive engine build, a slice per timer tick.
+        if cls.engine.init_progress >= 1:
+            return
+        progress = cls.engine.init_step(time_budget)
+        set_if_changed(settings, "init_progress", progress, 2)
+        if progress >= 1:
+            cls.memory_update(settings, force=True)
+            # Mirrored pins added before the mirror table was built get their twin now.
+            PinRegistry.dirty = True
+
+    @classmethod
+    def adaptive_level(cls, settings, quality, iterations):
+        # Cheaper springs and fewer iterations while the mouse pin is held, ramped back up over
+        # settle_ticks after release. The lower levels are the first columns of the full quality
+        # sample, so switching between them never resamples.
+        if cls.mouse_pin:
+            cls.settle_left = settings.settle_ticks
+            t = 0
+        elif cls.settle_left > 0:
+            cls.settle_left -= 1
+            t = 1 - cls.settle_left / (settings.settle_ticks + 1)
+        else:
+            return quality, iterations
+
+        grab_quality = min(settings.grab_quality, quality)
+        grab_iterations = min(settings.grab_iterations, iterations)
+        return (round(grab_quality + (quality - grab_quality) * t),
+                round(grab_iterations + (iterations - grab_iterations) * t))
+
+    @classmethod
+    @traced("step")
     def step(cls):
         settings = get_settings(bpy.context)
 
         cls.engine.sizing = settings.scale
+        cls.engine.weighted_sampling = settings.weighted_sampling
+        quality = min(settings.quality, settings.quality_limit) if settings.quality_limit else settings.quality
+        iterations = settings.iterations
+        if settings.adaptive_quality:
+            quality, iterations = cls.adaptive_level(settings, quality, iterations)
 
         if settings.drag < 1:
-            cls.engine.movement_step(drag=1 - settings.drag)
-
-        for i in range(settings.iterations):
-            cls.engine.springs_force_apply(stiffness=settings.stiffness,
-                                           springs=settings.quality,
-                                           factor=settings.tension)
-            cls.engine.pins_apply()
+            with span("movement_step"):
+                cls.engine.movement_step(drag=1 - settings.drag)
+
+        for i in range(iterations):
+            if settings.solver == "IMPLICIT":
+                with span("implicit_solve", springs=quality):
+                    cls.engine.implicit_solve(factor=settings.tension,
+                                              springs=quality,
+                                              cg_iterations=settings.cg_iterations)
+            else:
+                with span("springs_force_apply", springs=quality):
+                    cls.engine.springs_force_apply(stiffness=settings.stiffness,
+                                                   springs=quality,
+                                                   factor=settings.tension)
+            with span("pins_apply"):
+                cls.engine.pins_apply()
         if settings.smoothing > 0:
-            cls.engine.smooth(factor=settings.smoothing)
+            with span("smooth"):
+                cls.engine.smooth(factor=settings.smoothing)
+
+        if settings.self_collision > 0:
+            with span("repulsion_apply"):
+                cls.engine.repulsion_apply(factor=settings.self_collision, distance=settings.collision_distance)
 
         if settings.target_attraction > 0 and cls.target_bm:
-            cls.engine.target_attract(factor=settings.target_attraction)
+            with span("target_attract"):
+                cls.engine.target_attract(factor=settings.target_attraction)
 
         if settings.x_mirror:
-            cls.engine.x_mirror_apply()
+            with span("x_mirror_apply"):
+                cls.engine.x_mirror_apply()
+
+        with span("snapshot"):
+            cls.engine.history_setup(settings.history_size * 2 ** 20, settings.history_half_precision)
+            cls.engine.snapshot()
+        cls.memory_update(settings)
 
+    @classmethod
+    def memory_update(cls, settings, force=False):
+        # The panel figures, refreshed twice per second at most.
+        now = time.perf_counter()
+        if not force and now - cls.last_memory_update < 0.5:
+            return
+        cls.last_memory_update = now
+        set_if_changed(settings, "history_memory", cls.engine.history_nbytes() / 2 ** 20)
+        set_if_changed(settings, "engine_memory", cls.engine.memory_usage() / 2 ** 20)
+
+    @classmethod
+    @traced("write_back")
+    def write_back(cls, settings, force=False):
+        # Separate stage from step, several steps are coalesced into one mesh update
+        # at most update_rate times per second, and nothing is written if no vertex moved.
+        now = time.perf_counter()
+        if not force:
+            if settings.update_rate > 0 and now - cls.last_write < 1 / settings.update_rate:
+                return False
+            if not cls.engine.moved(cls.written_co):
+                return False
+        cls.last_write = now
         cls.engine.back_to_bm()
         if settings.source_mesh.mode == "OBJECT":
-            cls.engine.bm.to_mesh(settings.source_mesh.data)
+            mesh = settings.source_mesh.data
+            cls.engine.bm.to_mesh(mesh)
+            mesh.vertices.foreach_set("normal", cls.engine.vertex_normals().ravel())
+            cls.written_co = cls.engine.co.copy()
+        return True
+
+
+@register_class
+class SoftwrapRewind(bpy.types.Operator):
+    bl_idname = "softwrap.rewind"
+    bl_label = "Rewind"
+    bl_description = "Jump back in the simulation history"
+    bl_options = {"REGISTER"}
+
+    ticks: bpy.props.IntProperty(name="Ticks", min=1, default=50)
+
+    @classmethod
+    def poll(cls, context):
+        return CurrEngine.engine is not None
+
+    def execute(self, context):
+        settings = get_settings(context)
+        if not CurrEngine.engine.rewind(self.ticks):
+            self.report({"WARNING"}, message="No history to rewind")
+            return {"CANCELLED"}
+        CurrEngine.memory_update(settings, force=True)
+        CurrEngine.write_back(settings, force=True)
+        return {"FINISHED"}
 
 @register_class
 class SoftwrapMain(bpy.types.Operator):
@@ -209,6 +483,11 @@ class SoftwrapMain(bpy.types.Operator):
         return {"RUNNING_MODAL"}
 
     def modal(self, context, event):
+        # Blender checks the argument count of modal, so it's wrapped here instead of decorated.
+        with span("modal", event=event.type):
+            return self._modal(context, event)
+
+    def _modal(self, context, event):
         settings = get_settings(context)
 
         if not CurrEngine.engine or not settings.source_mesh or \
@@ -237,9 +516,12 @@ class SoftwrapMain(bpy.types.Operator):
             CurrEngine.mouse_pin_remove()
 
         elif event.type == "TIMER":
+            CurrEngine.init_step(settings)
+            CurrEngine.topology_update(context)
             CurrEngine.pins_update(context, event)
             if not settings.pause:
                 CurrEngine.step()
+            CurrEngine.write_back(settings)
             CurrEngine.draw(context)
             context.area.tag_redraw()
 
@@ -0,0 +1,62 @@
+'''
+Memory footprint of the reference engine (springs.SpringEngine), computed from the mesh size and
+settings before anything is allocated. Kept free of numpy so the panel can use it without loading the engine.
+'''
+
+INT = 8
+FLOAT = 8
+SAMPLE_BLOCK = 4096
+STEP_BLOCK = 4096
+
+
+def estimate_memory(n, max_springs, quality, stiffness, immediate_edges_max=6, x_mirror=False, implicit=False,
+                    out_of_core=False, self_collision=False, history_bytes=0):
+    # Returns (persistent, peak temporaries) in bytes, memory mapped tables (out_of_core) aren't counted.
+    # The target mesh isn't counted, its arrays are built before the source ones are freed.
+    # history_bytes is the history cap, the snapshot ring never grows past it.
+    stiffness = min(stiffness, max_springs)
+    quality = min(quality, stiffness)
+
+    persistent = n * 3 * FLOAT * 3                              # co, last_co, rest_co
+    if not out_of_core:
+        persistent += n * max_springs * (INT + FLOAT)           # springs, lengths
+    persistent += n * immediate_edges_max * (INT + 1)           # immediate_edges, invalid places
+    persistent += n * (INT * 3 + FLOAT)                         # edge counts, ring sizes, local lengths
+    persistent += n * quality * (INT + FLOAT)                   # sampled springs cache
+    persistent += n * 2 * 3 * INT                               # triangles, about two per vertex on quads
+    if x_mirror:
+        persistent += n * INT
+    if implicit:
+        persistent += n * quality * (INT * 2 + FLOAT) + n * INT  # constraint edges, degree
+    persistent += history_bytes
+
+    # springs_force_apply: gathered coordinates, differences, squared lengths, rescale, nan mask.
+    step = min(n, STEP_BLOCK) * quality * (3 * FLOAT * 2 + FLOAT * 2 + 3) + n * 3 * FLOAT
+    # Sampling: row block permutation and the picked columns, the gathered ids and lengths are the cache above.
+    sampling = min(n, SAMPLE_BLOCK) * stiffness * FLOAT * 3 + n * quality * INT
+    # Engine build: co, edges, polygon sizes and loops read as arrays, about 2 edges, 1 polygon and
+    # 4 loops per vertex on quads, with their int64 copies, then the directed first ring edges sorted by vertex.
+    build = n * 3 * (4 + FLOAT) + n * 2 * 2 * (4 + INT) + n * 2 * (4 + INT) + n * 4 * (4 + INT) * 2
+    build += n * 4 * INT * 4
+    peak = max(step, sampling, build)
+    if self_collision:
+        # Self collision candidate pairs, assuming a few neighbours per grid cell.
+        peak = max(peak, n * (INT * 6 + FLOAT * 8) * 4)
+    if implicit:
+        peak = max(peak, n * quality * 3 * FLOAT * 2 + n * 3 * FLOAT * 6)
+    return persistent, peak
+
+
+def fit_budget(n, budget, max_springs, quality, stiffness, **kwargs):
+    # Largest max_springs then quality (never under 4) whose estimate fits in budget bytes.
+    # Check the result with estimate_memory, 4 and 4 are returned even if they don't fit.
+    def total(max_springs, quality):
+        return sum(estimate_memory(n, max_springs, quality, min(stiffness, max_springs), **kwargs))
+
+    quality = min(quality, max_springs)
+    while max_springs > max(quality, 4) and total(max_springs, quality) > budget:
+        max_springs = max(max(quality, 4), int(max_springs * 0.9))
+    while quality > 4 and total(max_springs, quality) > budget:
+        quality = max(4, int(quality * 0.9))
+        max_springs = max(quality, 4)
+    return max_springs, quality
@@ -24,15 +24,22 @@ import traceback
 import os
 import sys
 
-_imported_modules = []
+_imported_modules = {}
+_module_mtimes = {}
 _modules = []
+_lazy_modules = []
 _register_classes = set()
 _register_functions = set()
 _unregister_functions = set()
+_registered = False
 
 
-def add_module(module_name):
-    _modules.append(module_name)
+def add_module(module_name, lazy=False):
+    # Lazy modules are only imported on the first load_module() call,
+    # keep heavy dependencies (numpy, gpu shaders) out of them at add-on startup.
+    modules = _lazy_modules if lazy else _modules
+    if module_name not in modules:
+        modules.append(module_name)
 
 
 def register_class(cls):
@@ -51,35 +58,74 @@ def unregister_function(func):
     return func
 
 
-def import_modules():
-    _register_classes.clear()
-    _register_functions.clear()
-    _unregister_functions.clear()
-    for imported_module in _imported_modules:
-        importlib.reload(imported_module)
-        print("reloaded", imported_module)
+def _module_mtime(module):
+    try:
+        return os.path.getmtime(module.__file__)
+    except (AttributeError, TypeError, OSError):
+        return None
+
+
+def _forget_module(module):
+    for registry in (_register_classes, _register_functions, _unregister_functions):
+        for item in [item for item in registry if item.__module__ == module.__name__]:
+            registry.discard(item)
+
+
+def _import_module(module_name):
+    module = _imported_modules.get(module_name, None)
+    if module is None:
+        module = importlib.import_module(f".{module_name}", __package__)
+
+    elif _module_mtime(module) != _module_mtimes.get(module_name, None):
+        _forget_module(module)
+        module = importlib.reload(module)
+        print("reloaded", module)
 
+    _imported_modules[module_name] = module
+    _module_mtimes[module_name] = _module_mtime(module)
+    return module
+
+
+def import_modules():
     for module_name in _modules:
-        try:
-            fake_globals = {"__name__": __name__}
-            exec(f"from . import {module_name}", fake_globals)
-            _imported_modules.append(fake_globals[module_name])
+        _import_module(module_name)
+
+    # Lazy modules loaded in a previous session are refreshed too, the others stay unloaded.
+    for module_name in _lazy_modules:
+        if module_name in _imported_modules:
+            _import_module(module_name)
+
+
+def load_module(module_name):
+    if module_name in _imported_modules:
+        return _imported_modules[module_name]
 
-        except Exception as e:
-            raise e
+    module = _import_module(module_name)
+    if _registered:
+        for item in _register_classes:
+            if item.__module__ == module.__name__:
+                bpy.utils.register_class(item)
+        for item in _register_functions:
+            if item.__module__ == module.__name__:
+                item()
+    return module
 
 
 def register():
+    global _registered
     for item in _register_classes:
         bpy.utils.register_class(item)
 
     for item in _register_functions:
         item()
+    _registered = True
 
 
 def unregister():
+    global _registered
     for item in _register_classes:
         bpy.utils.unregister_class(item)
 
     for item in _unregister_functions:
         item()
+    _registered = False
@@ -1,34 +1,183 @@
 import numpy as np
+import tempfile
+import time
 from mathutils.bvhtree import BVHTree
 from mathutils.kdtree import KDTree
 from mathutils.geometry import intersect_point_tri
-from .utils import DummyObj, n_ring
+from .utils import n_ring, Record, Pin, SpringSample, ImplicitSystem, EngineCache
+from .history import SnapshotRing
 from mathutils import Vector
 from random import random
 
+_GRID_OFFSETS = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)], dtype=np.int64)
+
+
+def _closest_on_triangles(p, a, b, c):
+    # Vectorized closest point on triangles (Ericson, Real-Time Collision Detection 5.1.5),
+    # regions are assigned from the lowest to the highest precedence so the first match of the original wins.
+    ab = b - a
+    ac = c - a
+    ap = p - a
+    bp = p - b
+    cp = p - c
+    d1 = (ab * ap).sum(axis=-1)
+    d2 = (ac * ap).sum(axis=-1)
+    d3 = (ab * bp).sum(axis=-1)
+    d4 = (ac * bp).sum(axis=-1)
+    d5 = (ab * cp).sum(axis=-1)
+    d6 = (ac * cp).sum(axis=-1)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denom = va + vb + vc
+        denom[denom == 0] = 1
+        result = a + ab * (vb / denom)[..., np.newaxis] + ac * (vc / denom)[..., np.newaxis]
+
+        region = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+        w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        result[region] = (b + (c - b) * w[..., np.newaxis])[region]
+
+        region = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+        w = d2 / (d2 - d6)
+        result[region] = (a + ac * w[..., np.newaxis])[region]
+
+        region = (d6 >= 0) & (d5 <= d6)
+        result[region] = c[region]
+
+        region = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+        v = d1 / (d1 - d3)
+        result[region] = (a + ab * v[..., np.newaxis])[region]
+
+        region = (d3 >= 0) & (d4 <= d3)
+        result[region] = b[region]
+
+        region = (d1 <= 0) & (d2 <= 0)
+        result[region] = a[region]
+    return result
+
+
+def topology_fingerprint(bm, edges=None):
+    # Identifies the connectivity of a mesh, positions are ignored. Expects valid vertex indices.
+    if edges is None:
+        edges = mesh_arrays(bm)[1]
+    return len(bm.verts), len(bm.edges), len(bm.faces), hash(edges.astype(np.int64).tobytes())
+
+
+def mesh_arrays(bm, mesh=None):
+    # Vertex coordinates, edges, polygon sizes and flat polygon vertex indices as arrays.
+    # Read with foreach_get from mesh, the Mesh bm was created from, or streamed from the bmesh
+    # element by element, never through per element tuples or lists.
+    if mesh is not None:
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", co)
+        edges = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+        mesh.edges.foreach_get("vertices", edges)
+        sizes = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_total", sizes)
+        loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", loop_starts)
+        loop_verts = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", loop_verts)
+        sizes = sizes.astype(np.int64)
+        loops = loop_verts[np.repeat(loop_starts, sizes) + _ranks(sizes)].astype(np.int64)
+        return co.astype(np.float64).reshape(-1, 3), edges.astype(np.int64).reshape(-1, 2), sizes, loops
+
+    co = np.fromiter((c for v in bm.verts for c in v.co), dtype=np.float64, count=3 * len(bm.verts))
+    edges = np.fromiter((v.index for e in bm.edges for v in e.verts), dtype=np.int64, count=2 * len(bm.edges))
+    sizes = np.fromiter((len(f.verts) for f in bm.faces), dtype=np.int64, count=len(bm.faces))
+    loops = np.fromiter((v.index for f in bm.faces for v in f.verts), dtype=np.int64, count=int(sizes.sum()))
+    return co.reshape(-1, 3), edges.reshape(-1, 2), sizes, loops
+
+
+def _ranks(counts):
+    # 0 .. count - 1 for every count, concatenated.
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def _fan_triangles(sizes, loops):
+    # Polygons as fans of triangles, returns the triangles and the first triangle of every polygon.
+    tri_counts = np.maximum(sizes - 2, 0)
+    first = (np.cumsum(sizes) - sizes)[np.repeat(np.arange(len(sizes)), tri_counts)]
+    j = _ranks(tri_counts) + 1
+    tris = np.stack((loops[first], loops[first + j], loops[first + j + 1]), axis=1).reshape(-1, 3)
+    return tris, np.cumsum(tri_counts) - tri_counts
+
+
+def _vert_boundary(n, edges, sizes, loops):
+    # Vertices on a boundary edge, an edge used by fewer than two polygons.
+    if not len(edges):
+        return np.zeros((n,), dtype=bool)
+    starts = np.cumsum(sizes) - sizes
+    following = np.arange(len(loops)) + 1
+    following[(starts + sizes - 1)[sizes > 0]] = starts[sizes > 0]
+    sides = np.sort(np.minimum(loops, loops[following]) * n + np.maximum(loops, loops[following]))
+    keys = edges.min(axis=1) * n + edges.max(axis=1)
+    face_counts = np.searchsorted(sides, keys, side="right") - np.searchsorted(sides, keys)
+    boundary = np.zeros((n,), dtype=bool)
+    boundary[edges[face_counts < 2].ravel()] = True
+    return boundary
+
+
+def _cache_nbytes(data, seen=None):
+    # Bytes of the arrays of a cache entry, records and dicts of them are walked.
+    # A view counts the whole array it keeps alive, once, the implicit levels slice their parent system.
+    if seen is None:
+        seen = set()
+    if isinstance(data, np.ndarray):
+        while isinstance(data.base, np.ndarray):
+            data = data.base
+        if id(data) in seen or isinstance(data, np.memmap):
+            return 0
+        seen.add(id(data))
+        return data.nbytes
+    if isinstance(data, (Record, dict)):
+        return sum(_cache_nbytes(value, seen) for value in data.values())
+    return 0
+
+
+def _grid_hash(cells, table_size):
+    # Spatial hash of integer grid cells, collisions are resolved later by comparing the actual cells.
+    h = (cells[:, 0] * 73856093) ^ (cells[:, 1] * 19349663) ^ (cells[:, 2] * 83492791)
+    return h % table_size
+
 
 class SpringEngine:
-    def __init__(self, source_bm, target_bm=None, max_springs=300, x_mirror=False, immediate_edges_max=6):
+    def __init__(self, source_bm, target_bm=None, max_springs=300, x_mirror=False, immediate_edges_max=6,
+                 seed=None, progressive=False, storage_dir=None, mesh=None):
+        # mesh is the Mesh source_bm was read from, unmodified, it's read with foreach_get if given.
+        # storage_dir None keeps the spring tables in memory, otherwise they are memory mapped
+        # temporary files in that directory ("" for the system temp directory).
+        self.storage_dir = storage_dir
+        # Vertex rows processed at once by the streaming kernels.
+        self.block_size = 4096
         self.max_springs = max_springs
         self.immediate_edges_max = immediate_edges_max
         self.bm = source_bm
         self.target_bm = target_bm
         self.n = len(source_bm.verts)
-        self.co = np.array(list(tuple(v.co) for v in source_bm.verts), dtype=np.float64)
+        self.co, edges, sizes, loops = mesh_arrays(source_bm, mesh)
         self.last_co = self.co.copy()
-        self.springs = np.zeros((self.n, max_springs), dtype=np.int64)
+        # Positions the rest lengths are measured on, the bmesh moves with the simulation.
+        self.rest_co = self.co.copy()
+        self.springs = self._table((self.n, max_springs), np.int64)
         self.immediate_edges = np.full((self.n, immediate_edges_max), -1, dtype=np.int64)
-        self.lengths = np.zeros((self.n, max_springs), dtype=np.float64)
+        self.lengths = self._table((self.n, max_springs), np.float64)
         self.sizing = 1
+        self.weighted_sampling = False
+        self.rng = np.random.RandomState(seed)
+        self.link_counts = np.zeros((self.n,), dtype=np.int64)
+        self.ring_sizes = np.zeros((self.n,), dtype=np.int64)
+        self.index_map = None
 
         self.pins = []
-        self.out_cache = DummyObj()
+        self.out_cache = EngineCache()
+        self.history = None
 
-        if target_bm:
-            target_bm.faces.ensure_lookup_table()
-            self.bvh = BVHTree.FromBMesh(target_bm)
-        else:
-            self.bvh = None
+        # The target BVH and tables are built last by _init_stages, target_attract waits for them.
+        self.target_ready = False
+        self.bvh = None
 
         source_bm.verts.ensure_lookup_table()
         source_bm.faces.ensure_lookup_table()
@@ -36,58 +185,391 @@ class SpringEngine:
         if x_mirror:
             self.mirror_table = np.full((self.n,), -1, dtype=np.int64)
             self.x_mirr = True
-            kd = KDTree(self.n)
-            for vert in source_bm.verts:
-                kd.insert(vert.co, vert.index)
-            kd.balance()
         else:
             self.x_mirr = False
             self._mirror_table = None
 
-        for vert in source_bm.verts:
-            for j, edge in enumerate(vert.link_edges):
-                if not j < immediate_edges_max:
+        self.tris = _fan_triangles(sizes, loops)[0]
+        self.fingerprint = topology_fingerprint(source_bm, edges)
+        self.boundary = _vert_boundary(self.n, edges, sizes, loops)
+        self.init_progress = 0
+        self._init_job = self._init_stages(source_bm, target_bm)
+        if progressive:
+            # The simulation can start on the first ring right away, init_step streams in the rest.
+            self._first_ring_build(edges, self.boundary)
+            self._derived_tables_update()
+        else:
+            self.init_step()
+
+    def _table(self, shape, dtype):
+        # Zeroed dense table, file backed in out of core mode. The temporary file is deleted
+        # by the OS once the map is released.
+        if self.storage_dir is None or not shape[0] * shape[1]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(tempfile.TemporaryFile(dir=self.storage_dir or None), dtype=dtype, mode="w+", shape=shape)
+
+    def _first_ring_build(self, edges, boundary):
+        # Vectorized first ring for every vertex, repeated cyclically over the spring columns
+        # so sampled springs never hit the empty part of a row that isn't built yet.
+        src = np.concatenate((edges[:, 0], edges[:, 1]))
+        dst = np.concatenate((edges[:, 1], edges[:, 0]))[np.argsort(src, kind="stable")]
+        degree = np.bincount(src, minlength=self.n)
+        del src
+        starts = np.cumsum(degree) - degree
+        self.link_counts = degree
+        self.ring_sizes = np.minimum(degree, self.max_springs)
+
+        isolated = np.flatnonzero(degree == 0)
+        self.springs[isolated] = isolated[:, np.newaxis]
+        k = np.arange(self.immediate_edges_max)[np.newaxis, :]
+        all_rows = np.flatnonzero(degree)
+        for start in range(0, len(all_rows), self.block_size):
+            rows = all_rows[start:start + self.block_size]
+            columns = np.arange(self.max_springs)[np.newaxis, :] % degree[rows][:, np.newaxis]
+            springs = dst[starts[rows][:, np.newaxis] + columns]
+            self.springs[rows] = springs
+            d = self.rest_co[springs] - self.rest_co[rows][:, np.newaxis]
+            self.lengths[rows] = np.sqrt((d * d).sum(axis=2))
+
+            # Same boundary rule as _vert_tables_build.
+            inside = k < degree[rows][:, np.newaxis]
+            others = dst[np.minimum(starts[rows][:, np.newaxis] + k, len(dst) - 1)]
+            row_boundary = boundary[rows][:, np.newaxis]
+            keep = inside & (~row_boundary | (boundary[others] == row_boundary))
+            self.immediate_edges[rows] = np.where(keep, others, -1)
+
+    def _init_stages(self, source_bm, target_bm, chunk=256):
+        # Generator doing the expensive part of __init__, yields the progress in [0, 1).
+        # The per vertex loops check the init_step deadline after every vertex, a chunk of n_ring
+        # walks can take far longer than a time slice.
+        verts = source_bm.verts
+        start = 0
+        while start < self.n:
+            stop = min(start + chunk, self.n)
+            i = start
+            while i < stop:
+                self._vert_tables_build(verts[i])
+                i += 1
+                if time.perf_counter() > self._init_deadline:
                     break
-                other = edge.other_vert(vert)
-                if not vert.is_boundary or other.is_boundary == vert.is_boundary:
-                    self.immediate_edges[vert.index, j] = other.index
+            self._cache_rows_update(np.arange(start, i))
+            start = i
+            yield start / max(self.n, 1) * 0.8
+
+        if self.x_mirr:
+            kd = KDTree(self.n)
+            for i, co in enumerate(self.rest_co):
+                kd.insert(co, i)
+                if time.perf_counter() > self._init_deadline:
+                    yield 0.8 + i / max(self.n, 1) * 0.05
+            kd.balance()
+            for i in range(self.n):
+                self._vert_mirror_build(i, kd)
+                if time.perf_counter() > self._init_deadline:
+                    yield 0.85 + i / max(self.n, 1) * 0.05
 
-            for j, other in enumerate(n_ring(vert, self.max_springs)):
-                self.springs[vert.index, j] = other.index
-                self.lengths[vert.index, j] = (other.co - vert.co).length
+        yield 0.9
+        self._derived_tables_update()
+        if target_bm:
+            yield 0.92
+            target_bm.faces.ensure_lookup_table()
+            self.bvh = BVHTree.FromBMesh(target_bm)
+            yield 0.95
+            self._target_build(target_bm)
+        # Built on first ring only rows, rebuilt on its next use.
+        self.out_cache.implicit = None
 
-            if self.x_mirr:
-                co = vert.co.copy()
-                co.x *= -1
-                mirrco, mirri, dist = kd.find(co)
-                self.mirror_table[vert.index] = mirri
+    def init_step(self, time_budget=None):
+        # Runs the pending initialization for about time_budget seconds, or to the end if None.
+        # Returns the progress, 1 once the engine is fully built.
+        if self._init_job is None:
+            return self.init_progress
+        self._init_deadline = time.perf_counter() + time_budget if time_budget is not None else float("inf")
+        for progress in self._init_job:
+            self.init_progress = progress
+            if time.perf_counter() > self._init_deadline:
+                return progress
+        self._init_job = None
+        self.init_progress = 1
+        # Samples taken while rows were partial favour their first columns, weighted ones only
+        # reach the first ring, the next step resamples on the full table.
+        self.out_cache.springs_ids = None
+        return 1
+
+    def _cache_rows_update(self, rows):
+        data = self.out_cache.springs_ids
+        if data is not None and data.columns is not None:
+            data.ids[rows] = self.springs[rows[:, np.newaxis], data.columns[rows]]
+            data.lengths[rows] = self.lengths[rows[:, np.newaxis], data.columns[rows]]
 
+    def _mirror_kd(self):
+        kd = KDTree(self.n)
+        for i, co in enumerate(self.rest_co):
+            kd.insert(co, i)
+        kd.balance()
+        return kd
+
+    def _vert_tables_build(self, vert):
+        i = vert.index
+        self.link_counts[i] = len(vert.link_edges)
+        self.immediate_edges[i] = -1
+        for j, edge in enumerate(vert.link_edges):
+            if not j < self.immediate_edges_max:
+                break
+            other = edge.other_vert(vert).index
+            if not self.boundary[i] or self.boundary[other] == self.boundary[i]:
+                self.immediate_edges[i, j] = other
+
+        ring = [other.index for other in n_ring(vert, self.max_springs)]
+        k = len(ring)
+        self.ring_sizes[i] = k
+        if not k:
+            # Isolated vertex, springs to itself have no effect.
+            self.springs[i] = i
+            self.lengths[i] = 0
+            return
+        # Rows of small islands repeat their ring over the padding, like _first_ring_build,
+        # so sampled columns past ring_sizes are still real springs.
+        columns = np.arange(self.max_springs) % k
+        ring = np.array(ring, dtype=np.int64)
+        d = self.rest_co[ring] - self.rest_co[i]
+        self.springs[i] = ring[columns]
+        self.lengths[i] = np.sqrt((d * d).sum(axis=1))[columns]
+
+    def _vert_mirror_build(self, i, kd):
+        x, y, z = self.rest_co[i]
+        mirrco, mirri, dist = kd.find((-x, y, z))
+        self.mirror_table[i] = mirri
+
+    def _derived_tables_update(self):
         self.immediate_edges_invalid_places = self.immediate_edges == -1
-        self.immediate_edges_number = (immediate_edges_max - self.immediate_edges_invalid_places.sum(axis=1))
+        self.immediate_edges_number = (self.immediate_edges_max - self.immediate_edges_invalid_places.sum(axis=1))
+
+        # n_ring yields the first ring first, so the leading columns of lengths are the edge lengths.
+        ring = np.minimum(self.link_counts, self.max_springs)
+        columns = int(ring.max()) if self.n else 0
+        first_ring = np.arange(columns)[np.newaxis, :] < ring[:, np.newaxis]
+        self.local_lengths = (self.lengths[:, :columns] * first_ring).sum(axis=1) / np.maximum(ring, 1)
+
+    def vertex_normals(self):
+        # Area weighted vertex normals of the current coordinates, the cross product length is twice the area.
+        tri_co = self.co[self.tris]
+        face_normals = np.cross(tri_co[:, 1] - tri_co[:, 0], tri_co[:, 2] - tri_co[:, 0])
+        corners = self.tris.ravel()
+        normals = np.empty((self.n, 3), dtype=np.float64)
+        for axis in range(3):
+            normals[:, axis] = np.bincount(corners, weights=np.repeat(face_normals[:, axis], 3), minlength=self.n)
+        length = np.sqrt((normals * normals).sum(axis=1))
+        length[length == 0] = 1
+        normals /= length[:, np.newaxis]
+        return normals
+
+    def topology_changed(self, bm):
+        return topology_fingerprint(bm) != self.fingerprint
+
+    def rebuild(self, bm, reference_co=None, mesh=None):
+        # Incremental __init__ after local topology edits of the source mesh.
+        # Vertices are matched to the old ones by position (reference_co, the engine coordinates
+        # when the mesh was last written), only rows whose spring ring reaches an edited vertex are rebuilt.
+        # Returns the number of rebuilt rows, self.index_map maps old indices to new ones (-1 if removed).
+        self.init_step()
+        bm.verts.ensure_lookup_table()
+        bm.faces.ensure_lookup_table()
+        old_bm = self.bm
+        old_bm.verts.ensure_lookup_table()
+        old_n = self.n
+        if reference_co is None:
+            reference_co = self.co
+        n = len(bm.verts)
+        new_co, edges, sizes, loops = mesh_arrays(bm, mesh)
+
+        kd = KDTree(old_n)
+        for i, co in enumerate(reference_co):
+            kd.insert(co, i)
+        kd.balance()
+        tolerance = max(self.local_lengths.mean() * 1e-4, 1e-6) if old_n else 1e-6
+        new_to_old = np.full((n,), -1, dtype=np.int64)
+        old_to_new = np.full((old_n,), -1, dtype=np.int64)
+        for vert in bm.verts:
+            co, j, dist = kd.find(vert.co)
+            if j is not None and dist <= tolerance and old_to_new[j] == -1:
+                new_to_old[vert.index] = j
+                old_to_new[j] = vert.index
+
+        # A surviving vertex whose neighbours changed is as dirty as a new one.
+        changed = new_to_old == -1
+        for i in np.flatnonzero(~changed):
+            old_neighbours = set(old_to_new[e.other_vert(old_bm.verts[new_to_old[i]]).index]
+                                 for e in old_bm.verts[new_to_old[i]].link_edges)
+            vert = bm.verts[i]
+            if old_neighbours != set(e.other_vert(vert).index for e in vert.link_edges):
+                changed[i] = True
+
+        springs = self._table((n, self.max_springs), np.int64)
+        lengths = self._table((n, self.max_springs), np.float64)
+        immediate_edges = np.full((n, self.immediate_edges_max), -1, dtype=np.int64)
+        link_counts = np.zeros((n,), dtype=np.int64)
+        ring_sizes = np.zeros((n,), dtype=np.int64)
+        if self.x_mirr:
+            old_mirror = self.mirror_table
+            self.mirror_table = np.full((n,), -1, dtype=np.int64)
+
+        # Kept rows are remapped in blocks, the tables may not fit in memory at once.
+        keep = ~changed
+        all_kept = np.flatnonzero(keep)
+        for start in range(0, len(all_kept), self.block_size):
+            kept = all_kept[start:start + self.block_size]
+            old_kept = new_to_old[kept]
+            valid = np.arange(self.max_springs)[np.newaxis, :] < self.ring_sizes[old_kept][:, np.newaxis]
+            mapped = old_to_new[self.springs[old_kept]]
+            touched = (valid & ((mapped == -1) | changed[np.maximum(mapped, 0)])).any(axis=1)
+            keep[kept[touched]] = False
+            kept = kept[~touched]
+            old_kept = old_kept[~touched]
+
+            # Padding repeats the ring (or the vertex itself), so it maps like the valid columns.
+            springs[kept] = np.where(mapped[~touched] >= 0, mapped[~touched], kept[:, np.newaxis])
+            lengths[kept] = self.lengths[old_kept]
+            old_immediate = self.immediate_edges[old_kept]
+            immediate_edges[kept] = np.where(old_immediate >= 0, old_to_new[old_immediate], -1)
+            link_counts[kept] = self.link_counts[old_kept]
+            ring_sizes[kept] = self.ring_sizes[old_kept]
+            if self.x_mirr:
+                self.mirror_table[kept] = old_to_new[old_mirror[old_kept]]
+
+        self.n = n
+        self.bm = bm
+        self.springs = springs
+        self.lengths = lengths
+        self.immediate_edges = immediate_edges
+        self.link_counts = link_counts
+        self.ring_sizes = ring_sizes
+        self.boundary = _vert_boundary(n, edges, sizes, loops)
+        # Survivors keep their rest positions, only new vertices take theirs from the (deformed) mesh.
+        survivors = new_to_old >= 0
+        rest_co = new_co.copy()
+        rest_co[survivors] = self.rest_co[new_to_old[survivors]]
+        self.rest_co = rest_co
+
+        rebuild = np.flatnonzero(~keep)
+        for i in rebuild:
+            self._vert_tables_build(bm.verts[i])
+
+        if self.x_mirr:
+            mirror_rebuild = np.flatnonzero(~keep | (self.mirror_table == -1))
+            if len(mirror_rebuild):
+                kd = self._mirror_kd()
+                for i in mirror_rebuild:
+                    self._vert_mirror_build(i, kd)
+
+        last_co = new_co.copy()
+        new_co[survivors] = self.co[new_to_old[survivors]]
+        last_co[survivors] = self.last_co[new_to_old[survivors]]
+        self.co = new_co
+        self.last_co = last_co
+        self._derived_tables_update()
+        self.tris = _fan_triangles(sizes, loops)[0]
+        self.fingerprint = topology_fingerprint(bm, edges)
+        self.index_map = old_to_new
+        if self.bvh:
+            self.target_hints = np.full((n,), -1, dtype=np.int64)
+        self.out_cache = EngineCache()
+        self.pins.clear()
+        if self.history is not None:
+            self.history.clear()
+        return len(rebuild)
 
     def _stiffness_springs_clamp(self, stiffness, springs):
         stiffness = min(stiffness, self.max_springs)
         springs = min(stiffness, springs)
         return stiffness, springs
 
+    def _springs_sample(self, stiffness, springs, block=4096):
+        # Picks springs distinct columns out of the first stiffness ones for every vertex,
+        # the first 4 columns (immediate neighbours) are always kept.
+        idy = np.empty((self.n, springs), dtype=np.int64)
+        if springs == stiffness or springs <= 4:
+            idy[:] = np.arange(springs)
+            return idy
+
+        idy[:, :4] = np.arange(4)
+        for start in range(0, self.n, block):
+            stop = min(start + block, self.n)
+            rows = np.arange(stop - start)
+
+            if self.weighted_sampling:
+                # Weighted sampling without replacement (Efraimidis-Spirakis), closer springs are likelier.
+                # Padding past ring_sizes gets zero weight, it's only picked when a row runs out of springs.
+                lengths = self.lengths[start:stop, 4:stiffness]
+                weights = 1 / np.maximum(lengths, 1e-12)
+                keys = np.log(self.rng.random_sample(lengths.shape)) / weights
+                keys[np.arange(4, stiffness)[np.newaxis, :] >= self.ring_sizes[start:stop, np.newaxis]] = -np.inf
+                picked = np.argpartition(-keys, springs - 5, axis=1)[:, :springs - 4]
+                # Sorted by key so every prefix is a weighted sample too, see _springs_sample_cached.
+                order = np.argsort(-keys[rows[:, np.newaxis], picked], axis=1)
+                picked = picked[rows[:, np.newaxis], order]
+                idy[start:stop, 4:] = picked + 4
+                continue
+
+            if (springs - 4) * 2 <= stiffness - 4:
+                idy[start:stop, 4:] = self._distinct_columns(stop - start, 4, stiffness, springs - 4)
+                continue
+
+            # Partial Fisher-Yates when most columns are picked anyway, O(stiffness) per row
+            # with stiffness under twice springs.
+            perm = np.tile(np.arange(stiffness, dtype=np.int64), (stop - start, 1))
+            for j in range(4, springs):
+                r = self.rng.randint(j, stiffness, size=stop - start)
+                picked = perm[rows, r]
+                perm[rows, r] = perm[:, j]
+                perm[:, j] = picked
+            idy[start:stop, 4:] = perm[:, 4:springs]
+        return idy
+
+    def _distinct_columns(self, rows, low, high, count):
+        # count distinct random columns in [low, high) per row in random order, by rejection:
+        # repeated values are redrawn until none is left, O(count log count) per row when count
+        # is small against the range. Every prefix of a row is a uniform sample too.
+        picked = self.rng.randint(low, high, size=(rows, count))
+        pending = np.arange(rows)
+        while len(pending):
+            sub = picked[pending]
+            order = np.argsort(sub, axis=1, kind="stable")
+            ranked = np.take_along_axis(sub, order, axis=1)
+            repeated = np.zeros(sub.shape, dtype=bool)
+            np.put_along_axis(repeated, order[:, 1:], ranked[:, 1:] == ranked[:, :-1], axis=1)
+            r, c = np.nonzero(repeated)
+            if not len(r):
+                break
+            picked[pending[r], c] = self.rng.randint(low, high, size=len(r))
+            pending = pending[np.unique(r)]
+        return picked
+
     def _springs_sample_cached(self, stiffness=100, springs=30):
         if self.out_cache.springs_ids:
             data = self.out_cache.springs_ids
-            if data.stiffness == stiffness and data.springs == springs:
-                return data.ids, data.lengths
+            if data.stiffness == stiffness and data.weighted == self.weighted_sampling:
+                if data.springs == springs:
+                    return data.ids, data.lengths
+                if data.springs > springs:
+                    # Cheaper level of the same sample, its first columns are a smaller sample already.
+                    return data.ids[:, :springs], data.lengths[:, :springs]
 
         stiffness, springs = self._stiffness_springs_clamp(stiffness, springs)
 
-        idx = np.arange(springs * self.n) // springs
-        idx.shape = self.n, springs
-        rnd = np.random.sample(self.n * stiffness)
-        rnd.shape = self.n, stiffness
-        idy = np.argsort(rnd, axis=1)[:, :springs]
-        if not springs == stiffness:
-            idy[:, :4] = range(4)
+        idy = self._springs_sample(stiffness, springs)
+        ids = np.empty((self.n, springs), dtype=np.int64)
+        lengths = np.empty((self.n, springs), dtype=np.float64)
+        for start in range(0, self.n, self.block_size):
+            stop = min(start + self.block_size, self.n)
+            idx = np.arange(start, stop)[:, np.newaxis]
+            ids[start:stop] = self.springs[idx, idy[start:stop]]
+            lengths[start:stop] = self.lengths[idx, idy[start:stop]]
 
-        data = DummyObj(stiffness=stiffness, springs=springs, ids=self.springs[idx, idy],
-                        lengths=self.lengths[idx, idy])
+        # The columns are only kept while init_step may still replace rows.
+        data = SpringSample(stiffness=stiffness, springs=springs, weighted=self.weighted_sampling,
+                            ids=ids, lengths=lengths,
+                            columns=idy if self._init_job is not None else None)
         self.out_cache.springs_ids = data
         return data.ids, data.lengths
 
@@ -101,7 +583,7 @@ class SpringEngine:
             factor = factor - 0.5
 
     def random_co(self, factor=0.5):
-        rnd = np.random.sample(self.n * 3)
+        rnd = self.rng.random_sample(self.n * 3)
         rnd -= 0.5
         rnd *= 2 * factor
         rnd.shape = self.n, 3
@@ -111,27 +593,282 @@ class SpringEngine:
         stiffness, springs = self._stiffness_springs_clamp(stiffness, springs)
         ids, lengths = self._springs_sample_cached(stiffness, springs)
         co = self.co
-        sco = self.co[ids]
-        co.shape = self.n, 1, 3
-        d = co - sco
-        dle = (d * d).sum(axis=2)
-        rescale = (((lengths * self.sizing) ** 2) / dle)
-        d *= rescale[:, :, np.newaxis]
-        nan = np.isnan(d)
-        d[nan] = 0
-        new_co = (d + sco).sum(axis=1) / springs
-        co.shape = self.n, 3
+        new_co = np.empty_like(co)
+        # Streamed over vertex blocks, the temporaries stay block_size * springs wide.
+        for start in range(0, self.n, self.block_size):
+            stop = min(start + self.block_size, self.n)
+            sco = co[ids[start:stop]]
+            d = co[start:stop, np.newaxis, :] - sco
+            dle = (d * d).sum(axis=2)
+            rescale = (((lengths[start:stop] * self.sizing) ** 2) / dle)
+            d *= rescale[:, :, np.newaxis]
+            nan = np.isnan(d)
+            d[nan] = 0
+            new_co[start:stop] = (d + sco).sum(axis=1) / springs
         self.co = new_co * factor + co * (1 - factor)
 
+    def _target_build(self, target_bm, max_neighbours=16):
+        # Target triangles with their vertex adjacency, used to search the nearest surface point
+        # around the triangle found on the previous step before falling back to the BVH.
+        self.target_co, edges, sizes, loops = mesh_arrays(target_bm)
+        self.target_tris, self.target_face_tri = _fan_triangles(sizes, loops)
+        tri_count = len(self.target_tris)
+
+        # Triangles incident to every vertex, in triangle order.
+        corner_verts = self.target_tris.ravel()
+        order = np.argsort(corner_verts, kind="stable")
+        incident = order // 3
+        incident_counts = np.bincount(corner_verts, minlength=len(self.target_co))
+        incident_starts = np.cumsum(incident_counts) - incident_counts
+
+        # Every triangle followed by the triangles around its 3 corners, without repeats and
+        # in that order, in blocks so the candidate lists stay small.
+        self.target_tri_neighbours = np.empty((tri_count, max_neighbours), dtype=np.int64)
+        for start in range(0, tri_count, self.block_size * 4):
+            tris = np.arange(start, min(start + self.block_size * 4, tri_count))
+            corners = self.target_tris[tris]
+            counts = incident_counts[corners]
+            lengths = counts.sum(axis=1) + 1
+            owner = np.repeat(np.arange(len(tris)), lengths)
+            corner_counts = counts.ravel()
+            candidates = np.empty(len(owner), dtype=np.int64)
+            heads = np.cumsum(lengths) - lengths
+            candidates[heads] = tris
+            tail = np.ones(len(owner), dtype=bool)
+            tail[heads] = False
+            candidates[tail] = incident[np.repeat(incident_starts[corners.ravel()], corner_counts) +
+                                        _ranks(corner_counts)]
+
+            first = np.sort(np.unique(owner * tri_count + candidates, return_index=True)[1])
+            owner = owner[first]
+            candidates = candidates[first]
+            rank = _ranks(np.bincount(owner, minlength=len(tris)))
+            keep = rank < max_neighbours
+            block = np.repeat(tris[:, np.newaxis], max_neighbours, axis=1)
+            block[owner[keep], rank[keep]] = candidates[keep]
+            self.target_tri_neighbours[tris] = block
+
+        tri_co = self.target_co[self.target_tris]
+        normals = np.cross(tri_co[:, 1] - tri_co[:, 0], tri_co[:, 2] - tri_co[:, 0])
+        length = np.sqrt((normals * normals).sum(axis=1))
+        length[length == 0] = 1
+        self.target_tri_normals = normals / length[:, np.newaxis]
+        edges = tri_co - np.roll(tri_co, 1, axis=1)
+        min_edge = np.sqrt((edges * edges).sum(axis=2)).min(axis=1)
+        # Local results closer than this are trusted, farther ones could belong to a fold outside the patch.
+        self.target_patch_radius = min_edge[self.target_tri_neighbours].min(axis=1) * 0.5
+        self.target_hints = np.full((self.n,), -1, dtype=np.int64)
+        self.target_ready = True
+
+    def _target_nearest(self, block=8192):
+        closest = np.empty((self.n, 3), dtype=np.float64)
+        normals = np.empty((self.n, 3), dtype=np.float64)
+        hints = self.target_hints
+        fallback = [np.flatnonzero(hints < 0)]
+
+        cached = np.flatnonzero(hints >= 0)
+        for start in range(0, len(cached), block):
+            verts = cached[start:start + block]
+            candidates = self.target_tri_neighbours[hints[verts]]
+            tri_co = self.target_co[self.target_tris[candidates]]
+            p = np.broadcast_to(self.co[verts][:, np.newaxis, :], candidates.shape + (3,))
+            points = _closest_on_triangles(p, tri_co[:, :, 0], tri_co[:, :, 1], tri_co[:, :, 2])
+            dist = ((p - points) ** 2).sum(axis=2)
+            best = dist.argmin(axis=1)
+            rows = np.arange(len(verts))
+            ok = dist[rows, best] <= self.target_patch_radius[hints[verts]] ** 2
+            best_tris = candidates[rows, best]
+            closest[verts[ok]] = points[rows, best][ok]
+            normals[verts[ok]] = self.target_tri_normals[best_tris[ok]]
+            hints[verts[ok]] = best_tris[ok]
+            fallback.append(verts[~ok])
+
+        for i in np.concatenate(fallback):
+            co1, normal, index, dist = self.bvh.find_nearest(self.co[i])
+            if co1 is None:
+                closest[i] = self.co[i]
+                normals[i] = 0
+                continue
+            closest[i] = co1
+            normals[i] = normal
+            hints[i] = self.target_face_tri[index]
+        return closest, normals
+
     def target_attract(self, factor=0.9):
-        for i in range(self.n):
-            v = self.bm.verts[i]
-            co0 = Vector(self.co[i])
-            co1, normal, index, dist = self.bvh.find_nearest(co0)
-            d = co0 - co1
-            if v.normal.dot(normal) < 0 and d.dot(normal) < 0:
-                d *= -1
-            self.co[i] -= d * factor * (v.normal.dot(normal) ** 2)
+        if not self.target_ready:
+            return
+        normals = self.vertex_normals()
+        closest, target_normals = self._target_nearest()
+        d = self.co - closest
+        dot = (normals * target_normals).sum(axis=1)
+        flip = (dot < 0) & ((d * target_normals).sum(axis=1) < 0)
+        d[flip] *= -1
+        self.co -= d * (factor * dot ** 2)[:, np.newaxis]
+
+    def _edge_keys(self):
+        # Sorted first ring pairs as i * n + j, both directions. n_ring yields the first ring first.
+        keys = self.out_cache.edge_keys
+        if keys is None:
+            ring = np.minimum(self.link_counts, self.max_springs)
+            columns = int(ring.max()) if self.n else 0
+            valid = np.arange(columns)[np.newaxis, :] < ring[:, np.newaxis]
+            rows = np.repeat(np.arange(self.n), ring)
+            keys = np.unique(rows * self.n + self.springs[:, :columns][valid])
+            self.out_cache.edge_keys = keys
+        return keys
+
+    def repulsion_apply(self, factor=0.5, distance=0.5):
+        # Pushes apart vertices that aren't edge neighbours and are closer than distance * their local
+        # edge length. Candidates come from hashed grid levels whose cells double in size from the
+        # median radius, every vertex is stored on the level whose cell fits its radius, so uneven
+        # densities still keep a few vertices per cell. A vertex searches the 27 cells around it on
+        # its own level and all coarser ones, finding every close pair once.
+        radius = self.local_lengths * (distance * self.sizing)
+        base = np.median(radius) if self.n else 0
+        if not base > 0:
+            return
+
+        levels = np.ceil(np.log2(np.maximum(radius, base) / base)).astype(np.int64)
+        edge_keys = self._edge_keys()
+        vert_cells = np.zeros((self.n, 3), dtype=np.int64)
+        delta = np.zeros((self.n, 3), dtype=np.float64)
+
+        for level in np.unique(levels):
+            cell_size = base * 2.0 ** level
+            members = np.flatnonzero(levels == level)
+            vert_cells[members] = np.floor(self.co[members] / cell_size)
+            table_size = 2 * len(members)
+            keys = _grid_hash(vert_cells[members], table_size)
+            order = members[np.argsort(keys, kind="stable")]
+            counts = np.bincount(keys, minlength=table_size)
+            starts = np.cumsum(counts) - counts
+
+            queries = np.flatnonzero(levels <= level)
+            query_cells = np.floor(self.co[queries] / cell_size).astype(np.int64)
+            for offset in _GRID_OFFSETS:
+                other_cells = query_cells + offset
+                other_keys = _grid_hash(other_cells, table_size)
+                cnt = counts[other_keys]
+                total = cnt.sum()
+                if not total:
+                    continue
+                qi = np.repeat(np.arange(len(queries)), cnt)
+                run_starts = np.repeat(np.cumsum(cnt) - cnt, cnt)
+                pj = order[np.arange(total) - run_starts + np.repeat(starts[other_keys], cnt)]
+                pi = queries[qi]
+
+                # Same level pairs are seen from both ends, keep one.
+                valid = (vert_cells[pj] == other_cells[qi]).all(axis=1)
+                valid &= (levels[pi] < level) | (pj > pi)
+                pi = pi[valid]
+                pj = pj[valid]
+                if len(edge_keys) and len(pi):
+                    key = pi * self.n + pj
+                    found = edge_keys[np.minimum(np.searchsorted(edge_keys, key), len(edge_keys) - 1)] == key
+                    pi = pi[~found]
+                    pj = pj[~found]
+                if not len(pi):
+                    continue
+
+                d = self.co[pi] - self.co[pj]
+                dist = np.sqrt((d * d).sum(axis=1))
+                r = (radius[pi] + radius[pj]) * 0.5
+                close = (dist < r) & (dist > 0)
+                if not close.any():
+                    continue
+                pi = pi[close]
+                pj = pj[close]
+                d = d[close]
+                dist = dist[close]
+                push = d * (((r[close] - dist) * 0.5 * factor) / dist)[:, np.newaxis]
+                for axis in range(3):
+                    delta[:, axis] += np.bincount(pi, weights=push[:, axis], minlength=self.n)
+                    delta[:, axis] -= np.bincount(pj, weights=push[:, axis], minlength=self.n)
+
+        self.co += delta
+
+    def _implicit_system(self, springs):
+        # Edge list of the spring graph over the first springs columns (nearest rings),
+        # deduplicated so every constraint appears once. Built once and cached until topology changes.
+        springs = max(1, min(springs, self.max_springs))
+        data = self.out_cache.implicit
+        if data and data.springs >= springs:
+            return data if data.springs == springs else self._implicit_level(data, springs)
+
+        # Column major, so the kept occurrence of every edge is its lowest column
+        # and the edges end up grouped by column.
+        valid = (np.arange(springs)[np.newaxis, :] < self.ring_sizes[:, np.newaxis]).T
+        rows = np.repeat(np.arange(self.n)[np.newaxis, :], springs, axis=0)[valid]
+        columns = np.repeat(np.arange(springs)[:, np.newaxis], self.n, axis=1)[valid]
+        cols = self.springs[:, :springs].T[valid]
+        rest = self.lengths[:, :springs].T[valid]
+        ei = np.minimum(rows, cols)
+        ej = np.maximum(rows, cols)
+        unique = np.sort(np.unique(ei * self.n + ej, return_index=True)[1])
+        ei, ej, rest = ei[unique], ej[unique], rest[unique]
+        degree = np.bincount(ei, minlength=self.n) + np.bincount(ej, minlength=self.n)
+        ends = np.searchsorted(columns[unique], np.arange(springs + 1))
+
+        data = ImplicitSystem(springs=springs, ei=ei, ej=ej, rest=rest, degree=degree, weight=1 / springs,
+                              ends=ends, levels={})
+        self.out_cache.implicit = data
+        return data
+
+    def _implicit_level(self, data, springs):
+        # System of the first springs columns sliced out of a bigger one, no rebuild needed.
+        level = data.levels.get(springs, None)
+        if level is None:
+            count = data.ends[springs]
+            ei, ej = data.ei[:count], data.ej[:count]
+            level = ImplicitSystem(springs=springs, ei=ei, ej=ej, rest=data.rest[:count],
+                                   degree=np.bincount(ei, minlength=self.n) + np.bincount(ej, minlength=self.n),
+                                   weight=1 / springs)
+            data.levels[springs] = level
+        return level
+
+    def _implicit_matvec(self, system, inertia, x):
+        # (inertia * I + weight * L) x, with L the graph laplacian of the constraints.
+        out = x * (inertia + system.weight * system.degree)[:, np.newaxis]
+        for axis in range(3):
+            out[:, axis] -= system.weight * (np.bincount(system.ei, weights=x[system.ej, axis], minlength=self.n) +
+                                             np.bincount(system.ej, weights=x[system.ei, axis], minlength=self.n))
+        return out
+
+    def implicit_solve(self, factor=0.99, springs=30, cg_iterations=8):
+        # Projective dynamics style step: the local step projects every spring to its rest length,
+        # the global step solves the linear system with conjugate gradients warm started at self.co.
+        system = self._implicit_system(springs)
+        inertia = max(1 - factor, 1e-3)
+        weight = system.weight
+        co = self.co
+
+        d = co[system.ei] - co[system.ej]
+        dle = np.sqrt((d * d).sum(axis=1))
+        p = d * ((system.rest * self.sizing) / np.maximum(dle, 1e-12))[:, np.newaxis]
+        b = co * inertia
+        for axis in range(3):
+            b[:, axis] += weight * (np.bincount(system.ei, weights=p[:, axis], minlength=self.n) -
+                                    np.bincount(system.ej, weights=p[:, axis], minlength=self.n))
+
+        # Jacobi preconditioned CG, the three coordinates are solved side by side.
+        diagonal = (inertia + weight * system.degree)[:, np.newaxis]
+        x = co.copy()
+        r = b - self._implicit_matvec(system, inertia, x)
+        z = r / diagonal
+        s = z.copy()
+        rz = (r * z).sum(axis=0)
+        for i in range(cg_iterations):
+            if not (rz > 1e-30).any():
+                break
+            As = self._implicit_matvec(system, inertia, s)
+            alpha = rz / np.maximum((s * As).sum(axis=0), 1e-30)
+            x += s * alpha
+            r -= As * alpha
+            z = r / diagonal
+            rz_new = (r * z).sum(axis=0)
+            s = z + s * (rz_new / np.maximum(rz, 1e-30))
+            rz = rz_new
+        self.co = x
 
     def movement_step(self, drag=1.0):
         d = self.co - self.last_co
@@ -140,17 +877,18 @@ class SpringEngine:
 
     def x_mirror_apply(self):
         if self.x_mirr:
-            mirrco = self.co[self.mirror_table]
+            # Rows not built yet by init_step are still -1.
+            built = self.mirror_table >= 0
+            mirrco = self.co[self.mirror_table[built]]
             mirrco[:, 0] *= -1
-            self.co += mirrco
-            self.co *= 0.5
+            self.co[built] += mirrco
+            self.co[built] *= 0.5
 
     def pins_apply(self):
         for pin in self.pins:
             idx = pin.vert_index
-            stiffness = max(min(pin.stiffness, self.max_springs), 0)
-            fallof = (1 - (np.arange(stiffness) / stiffness)) * pin.factor
-            fallof.shape = stiffness, 1
+            stiffness = pin.stiffness
+            fallof = pin.fallof
             ids = self.springs[idx, :stiffness]
             if pin.twisty:
                 self.co[idx] = pin.co
@@ -162,26 +900,65 @@ class SpringEngine:
                 newd = d * (((lengths * self.sizing) ** 2) / dle)[:, np.newaxis]
                 self.co[ids] = newd * fallof + d * (1 - fallof) + co
             else:
-                d = np.array(np.array(pin.co) - self.co[idx])
+                d = pin.co - self.co[idx]
                 self.co[idx] += d * pin.factor
                 self.co[ids] += d[np.newaxis, :] * fallof
 
     def add_pin(self, co, vert_index, stiffness=50, factor=0.99, twisty=False, x_mirr=False):
         stiffness = max(0, min(stiffness, self.max_springs))
         factor = max(0, min(factor, 1))
-        self.pins.append(DummyObj(co=co, vert_index=vert_index, stiffness=stiffness,
-                                  factor=factor, twisty=twisty))
-        if x_mirr and self.x_mirr:
+        # The fallof only depends on the pin settings, so it's computed once here instead of every iteration.
+        fallof = (1 - (np.arange(stiffness) / max(stiffness, 1))) * factor
+        fallof.shape = stiffness, 1
+        co = np.array(co, dtype=np.float64)
+        self.pins.append(Pin(co=co, vert_index=vert_index, stiffness=stiffness,
+                             factor=factor, twisty=twisty, fallof=fallof))
+        if x_mirr and self.x_mirr and self.mirror_table[vert_index] >= 0:
             co = co.copy()
             co[0] *= -1
             vert_index = self.mirror_table[vert_index]
-            self.pins.append(DummyObj(co=co, vert_index=vert_index, stiffness=stiffness,
-                                      factor=factor, twisty=twisty))
+            self.pins.append(Pin(co=co, vert_index=vert_index, stiffness=stiffness,
+                                 factor=factor, twisty=twisty, fallof=fallof))
 
     def clear_pins(self):
         self.pins.clear()
 
+    def history_setup(self, max_bytes, half_precision=True):
+        if max_bytes <= 0:
+            self.history = None
+            return
+        residual_dtype = np.float16 if half_precision else np.float32
+        if self.history is None or self.history.residual_dtype != residual_dtype:
+            self.history = SnapshotRing(max_bytes, half_precision=half_precision)
+        self.history.max_bytes = max_bytes
+
+    def snapshot(self):
+        if self.history is not None:
+            self.history.push(self.co, self.last_co)
+
+    def rewind(self, ticks):
+        state = self.history.rewind(ticks) if self.history is not None else None
+        if state is None:
+            return False
+        self.co, self.last_co = state
+        return True
+
+    def history_nbytes(self):
+        return self.history.nbytes if self.history is not None else 0
+
+    def memory_usage(self):
+        # Bytes held by the engine arrays, caches and history included.
+        # Memory mapped tables live on disk and are paged in on demand, they aren't counted.
+        total = sum(value.nbytes for value in vars(self).values()
+                    if isinstance(value, np.ndarray) and not isinstance(value, np.memmap))
+        return total + _cache_nbytes(self.out_cache) + self.history_nbytes()
+
+    def moved(self, reference_co, tolerance=0):
+        if reference_co is None or reference_co.shape != self.co.shape:
+            return True
+        return np.abs(self.co - reference_co).max() > tolerance
+
     def back_to_bm(self):
+        # Only the coordinates, normals come from vertex_normals() and are written to the mesh in bulk.
         for vert in self.bm.verts:
             vert.co = self.co[vert.index]
-        self.bm.normal_update()
@@ -0,0 +1,103 @@
+'''
+Opt-in performance tracer writing Chrome trace format JSON (chrome://tracing, Perfetto, speedscope).
+Spans are recorded as complete events with the thread they ran on, so modal ticks, engine stages
+and viewport redraws line up on one timeline. While stopped span() and traced() cost a global lookup.
+'''
+
+import functools
+import json
+import os
+import threading
+import time
+
+MAX_EVENTS = 1000000
+
+_events = None
+_thread_names = {}
+_start = 0
+
+
+def is_recording():
+    return _events is not None
+
+
+def start():
+    global _events, _start
+    _events = []
+    _thread_names.clear()
+    _start = time.perf_counter()
+
+
+def stop(path):
+    # Writes the recorded events to path and stops recording, returns the number of events written.
+    global _events
+    events, _events = _events, None
+    if events is None:
+        return 0
+    pid = os.getpid()
+    for tid, name in _thread_names.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return len(events)
+
+
+class _Span:
+    __slots__ = ("name", "args", "begin")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        events = _events
+        if events is None or len(events) >= MAX_EVENTS:
+            return False
+        thread = threading.current_thread()
+        _thread_names.setdefault(thread.ident, thread.name)
+        event = {"name": self.name, "cat": "softwrap", "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+                 "ts": (self.begin - _start) * 1e6, "dur": (end - self.begin) * 1e6}
+        if self.args:
+            event["args"] = self.args
+        events.append(event)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **args):
+    # with span("stage"): ..., a shared no-op context while not recording.
+    if _events is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name):
+    '''Decorator'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return func(*args, **kwargs)
+            with _Span(name, None):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
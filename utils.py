@@ -10,6 +10,40 @@ class DummyObj(dict):
     def __setattr__(self, key, value):
         self[key] = value
 
+
+class Record:
+    # Lightweight slotted record for data read in the per-tick loops, attribute reads
+    # are plain slot lookups instead of DummyObj's __getattr__ -> dict.get.
+    __slots__ = ()
+
+    def __init__(self, **kargs):
+        for key in self.__slots__:
+            setattr(self, key, kargs.get(key, None))
+
+    def values(self):
+        return [getattr(self, key) for key in self.__slots__]
+
+
+class Pin(Record):
+    __slots__ = ("co", "vert_index", "stiffness", "factor", "twisty", "fallof")
+
+
+class MousePin(Record):
+    __slots__ = ("co", "normal", "vert_index", "d")
+
+
+class SpringSample(Record):
+    __slots__ = ("stiffness", "springs", "weighted", "ids", "lengths", "columns")
+
+
+class ImplicitSystem(Record):
+    __slots__ = ("springs", "ei", "ej", "rest", "degree", "weight", "ends", "levels")
+
+
+class EngineCache(Record):
+    __slots__ = ("springs_ids", "implicit", "edge_keys")
+
+
 def n_ring(v, n=300):
     seen_verts = {v}
     curr_layer = [v]